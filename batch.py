@@ -0,0 +1,139 @@
+"""
+Runs several cleaning.cleaning() jobs from a json config in a pool of worker processes.
+The reference data shared by the jobs (census counties, vote margins, census regions, College Scorecard pages) is
+loaded once in the parent process before the workers start, so the workers reuse it (inherited on fork, from the disk
+caches otherwise) instead of each loading or downloading it again. Each output is written atomically, so a failed or
+interrupted job never leaves a partial file behind.
+
+The config has an optional 'workers' count and a list of 'jobs', each with a 'name', an 'input' csv (or 'all_counties'
+for the frame made by cleaning.get_all_counties), an 'output' csv and any other arguments of cleaning() (e.g., 'date_cols',
+'last_tracking_date', 'college_name', 'ignore_college'). See jobs.json.
+
+Usage:
+python batch.py jobs.json [--workers N] [--only name ...]
+"""
+import argparse
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cleaning
+import ingest
+import instrumentation
+import reference_data
+
+logger = logging.getLogger(__name__)
+ALL_COUNTIES = cleaning.ALL_COUNTIES
+
+
+def load_jobs(path, only=None):
+    """
+    Returns the number of workers and the list of jobs in a config file, checking every job has a name, input and output
+    and only passes arguments cleaning() accepts.
+
+    Arguments:
+    path -- json config file.
+    only -- names of the jobs to keep. Defaults to all of them.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    parameters = inspect.signature(cleaning.cleaning).parameters
+    jobs = []
+    for job in config['jobs']:
+        missing = {'name', 'input', 'output'} - set(job)
+        if missing:
+            raise ValueError(f'Job {job} is missing {sorted(missing)}.')
+        unknown = set(job) - {'name', 'input', 'output'} - set(parameters)
+        if unknown:
+            raise ValueError(f"Job '{job['name']}' has arguments cleaning() doesn't take: {sorted(unknown)}.")
+        if only is None or job['name'] in only:
+            jobs.append(job)
+    return config.get('workers'), jobs
+
+
+def cleaning_arguments(job):
+    """
+    Returns all arguments of cleaning() for a job, with the defaults filled in.
+    """
+    kwargs = {key: value for key, value in job.items() if key not in ('name', 'input', 'output')}
+    arguments = inspect.signature(cleaning.cleaning).bind_partial(**kwargs)
+    arguments.apply_defaults()
+    return arguments.arguments
+
+
+def preload(jobs):
+    """
+    Loads the reference data the jobs share, in this process, so the workers don't repeat it. Data kept in memory (vote
+    margins and stopwords) is inherited by forked workers; everything else is written to the disk caches the workers read.
+    """
+    reference_data.fetch('census_regions')
+    ingest.vote_margins()
+    arguments = [(job, cleaning_arguments(job)) for job in jobs]
+    if any(not kwargs['ignore_college'] for job, kwargs in arguments):
+        import name_matching
+        name_matching.get_stopwords()
+    census_vars = {json.dumps(kwargs['census_vars'], sort_keys=True) for job, kwargs in arguments
+                   if job['input'] == ALL_COUNTIES or not kwargs['skip_census']}
+    for vars in census_vars:
+        cleaning.get_census_counties(json.loads(vars)) # one API call per set of census vars instead of one per job
+    scorecard_vars = {json.dumps(kwargs['scorecard_vars'], sort_keys=True) for job, kwargs in arguments
+                      if kwargs['call_scoreboard_api'] and not kwargs['ignore_college']}
+    for vars in scorecard_vars:
+        cleaning.get_scorecard_data(json.loads(vars))
+
+
+def run_job(job):
+    """
+    Runs one job in a worker process and writes its output atomically. Returns the number of rows written and the wall time.
+    """
+    start = time.perf_counter()
+    rows = cleaning.clean_file(job['input'], job['output'], **cleaning_arguments(job))
+    return rows, time.perf_counter() - start
+
+
+def run_jobs(jobs, workers=None):
+    """
+    Runs the jobs in a pool of at most workers processes (one per CPU by default). Returns the names of the jobs that failed.
+    A failed job is logged and doesn't stop the others.
+
+    Arguments:
+    jobs -- list of job dictionaries (see load_jobs).
+    workers -- maximum number of jobs to run at the same time.
+    """
+    with instrumentation.timed('preload'):
+        preload(jobs)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    # fork so the workers inherit what preload loaded; other platforms fall back to their default and read the disk caches
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                rows, seconds = future.result()
+            except Exception:
+                logger.exception("Job '%s' failed", job['name'])
+                failed.append(job['name'])
+                continue
+            logger.info("Job '%s': wrote %d rows to %s in %.1fs", job['name'], rows, job['output'], seconds)
+    return failed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(name)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description='Run cleaning() jobs from a config file in parallel.')
+    parser.add_argument('config', help='json file with the jobs')
+    parser.add_argument('--workers', type=int, help='maximum number of jobs to run at the same time (default: config, then one per CPU)')
+    parser.add_argument('--only', nargs='+', help='names of the jobs to run')
+    args = parser.parse_args()
+
+    config_workers, jobs = load_jobs(args.config, args.only)
+    failed = run_jobs(jobs, args.workers or config_workers)
+    if failed:
+        sys.exit(f'{len(failed)} jobs failed: {", ".join(failed)}')
@@ -0,0 +1,181 @@
+"""
+Synthetic, realistically shaped inputs for benchmarking cleaning.py and dash_model.py without API keys or downloads.
+write_fixtures() fills a directory with the same files (and paths) the pipeline reads, a reference data cache,
+a fitted model and the college input frame, sized by one of the SCALES.
+"""
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+import us
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+# the full run has ~3200 counties, ~41k zips, ~7k Scorecard schools and ~1000 days of CAN data
+SCALES = {
+    'small': {'counties': 100, 'zips_per_county': 5, 'days': 120, 'schools': 500, 'colleges': 200},
+    'medium': {'counties': 1000, 'zips_per_county': 10, 'days': 400, 'schools': 3000, 'colleges': 2000},
+    'large': {'counties': 3200, 'zips_per_county': 13, 'days': 1000, 'schools': 7000, 'colleges': 20000},
+}
+CENSUS_VARS = {'B07011_001E': 'median_income', 'B01003_001E': 'total_population', 'B25010_003E': 'avg_hhsize'}
+REGIONS = ['Northeast', 'Midwest', 'South', 'West']
+WORDS = ['state', 'technical', 'community', 'north', 'south', 'east', 'west', 'saint', 'lake', 'river', 'valley', 'mount',
+         'christian', 'baptist', 'art', 'design', 'medical', 'law', 'polytechnic', 'institute', 'city', 'county', 'central']
+
+
+class StubCensus:
+    """
+    Stands in for census.Census: acs5.state_county returns made-up values for the fixture counties and counts its calls.
+    """
+    def __init__(self, counties, seed=0):
+        self.calls = 0
+        self.acs5 = self
+        rng = np.random.default_rng(seed)
+        self._values = {fips: (rng.normal(30000, 8000), int(rng.integers(1000, 1_000_000)), rng.normal(2.5, 0.3)) for fips in counties}
+
+    def state_county(self, fields, state_fips, county_fips):
+        self.calls += 1
+        rows = []
+        for fips, values in self._values.items():
+            state, county = f'{fips // 1000:02d}', f'{fips % 1000:03d}'
+            if state_fips not in ('*', state) or county_fips not in ('*', county):
+                continue
+            rows.append({**dict(zip(fields, values)), 'state': state, 'county': county})
+        return rows
+
+
+def fixture_counties(num_counties, seed=0):
+    """
+    Returns a dataframe of made-up counties spread over the 50 states, with their FIPS code and state abbreviation.
+    """
+    rng = np.random.default_rng(seed)
+    states = us.states.STATES
+    state_fips = np.array([int(state.fips) for state in states])
+    picked = rng.choice(len(states)*499, num_counties, replace=False) # distinct (state, odd county code) pairs
+    state_idx, county_codes = picked // 499, 2*(picked % 499) + 1
+    return pd.DataFrame({'STCOUNTYFP': state_fips[state_idx]*1000 + county_codes,
+                         'state': [states[i].abbr for i in state_idx]}).sort_values('STCOUNTYFP', ignore_index=True)
+
+
+def school_names(rng, n):
+    names = [' '.join(rng.choice(WORDS, rng.integers(1, 4))).title() for _ in range(n)]
+    return [f'{name} {rng.choice(["University", "College"])}' for name in names]
+
+
+def write_fixtures(directory, scale='small', seed=0):
+    """
+    Writes every input of the pipeline and the dashboard for the given scale into directory, which becomes the working
+    directory of the benchmark. Returns the college input frame, the census stub and a summary of the fixture sizes.
+    """
+    size = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    path = lambda *parts: os.path.join(directory, *parts)
+    counties = fixture_counties(size['counties'], seed)
+    fips = counties['STCOUNTYFP'].to_numpy()
+
+    # zip-county crosswalk
+    os.makedirs(path('zip-county-fips'), exist_ok=True)
+    zips = rng.permutation(np.arange(1000, 99999))[:len(fips)*size['zips_per_county']]
+    zip_county = pd.DataFrame({'ZIP': zips, 'STCOUNTYFP': np.repeat(fips, size['zips_per_county'])})
+    zip_county = zip_county.merge(counties, on='STCOUNTYFP').rename(columns={'state': 'STATE'})
+    zip_county['COUNTYNAME'] = 'County ' + zip_county['STCOUNTYFP'].astype(str)
+    zip_county['CLASSFP'] = 'H1'
+    zip_county[['ZIP', 'COUNTYNAME', 'STATE', 'STCOUNTYFP', 'CLASSFP']].to_csv(path('zip-county-fips', 'ZIP-COUNTY-FIPS_2017-06.csv'), index=False)
+
+    # CAN timeseries, with filler columns since the real file has many more than the pipeline reads
+    dates = pd.date_range('2020-03-01', periods=size['days']).strftime('%Y-%m-%d')
+    timeseries = pd.DataFrame({'date': np.tile(dates, len(fips)), 'country': 'US', 'state': np.repeat(counties['state'].to_numpy(), len(dates)),
+                               'county': 'County', 'fips': np.repeat(fips, len(dates))})
+    levels = rng.integers(0, 4, len(timeseries)).astype(float)
+    levels[rng.random(len(timeseries)) < 0.3] = np.nan
+    timeseries['communityLevels.canCommunityLevel'] = levels
+    for i in range(20):
+        timeseries[f'metrics.filler{i}'] = rng.random(len(timeseries)).round(4)
+    timeseries.to_csv(path('counties.timeseries.csv'), index=False)
+
+    # county presidential returns
+    os.makedirs(path('political-data'), exist_ok=True)
+    years = np.arange(2000, 2021, 4)
+    county_pres = pd.DataFrame([(year, party) for year in years for party in ['DEMOCRAT', 'REPUBLICAN', 'OTHER']], columns=['year', 'party'])
+    county_pres = county_pres.merge(counties, how='cross')
+    county_pres['candidatevotes'] = rng.integers(100, 50000, len(county_pres))
+    county_pres['totalvotes'] = county_pres.groupby(['year', 'STCOUNTYFP'])['candidatevotes'].transform('sum')
+    county_pres = county_pres.rename(columns={'STCOUNTYFP': 'county_fips', 'state': 'state_po'})
+    county_pres = county_pres.assign(state=county_pres['state_po'], county_name='COUNTY', office='US PRESIDENT', candidate='CANDIDATE',
+                                     version=20220315, mode='TOTAL')
+    county_pres[['year', 'state', 'state_po', 'county_name', 'county_fips', 'office', 'candidate', 'party', 'candidatevotes',
+                 'totalvotes', 'version', 'mode']].to_csv(path('political-data', 'countypres_2000-2020.csv'), index=False)
+
+    # College Scorecard listing
+    scoreboard = pd.DataFrame({'id': np.arange(100000, 100000 + size['schools']), 'school.name': school_names(rng, size['schools']),
+                               'school.zip': rng.choice(zips, size['schools']),
+                               '2020.student.size': rng.integers(100, 60000, size['schools']).astype(float)})
+    scoreboard.loc[rng.random(size['schools']) < 0.05, '2020.student.size'] = np.nan
+    scoreboard.to_csv(path('scoreboard_size.csv'), index=False)
+
+    # colleges to clean: most are Scorecard schools, some have extra words in their names
+    picked = scoreboard.sample(size['colleges'], replace=True, random_state=seed).reset_index(drop=True)
+    colleges = pd.DataFrame({'College': picked['school.name'] + np.where(rng.random(size['colleges']) < 0.3, ' Main Campus', ''),
+                             'zip': picked['school.zip'],
+                             'announce_date': pd.Timestamp('2021-04-01') + pd.to_timedelta(rng.integers(0, 200, size['colleges']), unit='D')})
+    colleges['College'] = colleges['College'] + ' ' + colleges.index.astype(str) # college names are unique
+    colleges['announce_date'] = colleges['announce_date'].dt.strftime('%m/%d/%Y')
+
+    # reference data cache, as written by reference_data.py
+    os.makedirs(path('.cache', 'reference'), exist_ok=True)
+    states = us.states.STATES
+    pd.DataFrame({'State': [s.name for s in states], 'State Code': [s.abbr for s in states],
+                  'Region': [REGIONS[i % 4] for i in range(len(states))], 'Division': 'Division'}).to_csv(path('.cache', 'reference', 'census_regions-fixture.csv'), index=False)
+    pd.DataFrame({'fips': fips, 'name': 'County ' + counties['STCOUNTYFP'].astype(str), 'state': counties['state']}).to_csv(path('.cache', 'reference', 'county_names-fixture.csv'), index=False)
+    features = []
+    for i, code in enumerate(fips):
+        x, y = -125 + (i % 60)*0.9, 25 + (i // 60)*0.45
+        ring = [[x + 0.9*np.cos(a)/2 + 0.45, y + 0.45*np.sin(a)/2 + 0.225] for a in np.linspace(0, 2*np.pi, 40)]
+        features.append({'type': 'Feature', 'id': f'{code:05d}', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    with open(path('.cache', 'reference', 'county_geojson-fixture.json'), 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    manifest = {name: {'url': '', 'file': f'{name}-fixture{ext}', 'sha256': 'fixture'}
+                for name, ext in [('census_regions', '.csv'), ('county_names', '.csv'), ('county_geojson', '.json')]}
+    with open(path('.cache', 'reference', 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    census = StubCensus(fips, seed)
+    write_dashboard_fixtures(directory, counties, census, rng)
+    summary = {'counties': len(fips), 'zips': len(zip_county), 'timeseries_rows': len(timeseries), 'schools': size['schools'],
+               'colleges': size['colleges']}
+    return colleges, census, summary
+
+
+def write_dashboard_fixtures(directory, counties, census, rng):
+    """
+    Writes college_data_county.csv (as made by the __main__ block of cleaning.py) and a small fitted booster model.
+    """
+    n = len(counties)
+    values = pd.DataFrame([census._values[fips] for fips in counties['STCOUNTYFP']], columns=list(CENSUS_VARS.values()))
+    college_data = pd.concat([values, pd.DataFrame({
+        'state_fips': (counties['STCOUNTYFP'] // 1000).map('{:02d}'.format), 'county_fips_str': (counties['STCOUNTYFP'] % 1000).map('{:03d}'.format),
+        'state': counties['state'], 'STCOUNTYFP': counties['STCOUNTYFP'], 'avg_community_level': rng.random(n)*3,
+        'political_control_state': rng.choice(['Dem', 'Rep', 'Div'], n), 'county_vote_diff': rng.normal(0, 0.3, n),
+        'State': counties['state'], 'State Code': counties['state'], 'Region': rng.choice(REGIONS, n), 'Division': 'Division'})], axis=1)
+    college_data.loc[rng.random(n) < 0.03, 'median_income'] = np.nan # some counties can't be predicted
+    college_data.to_csv(os.path.join(directory, 'college_data_county.csv'), index=False)
+
+    categorical_columns = ['ranking', 'Type', 'political_control_state', 'Region']
+    numerical_columns = ['announce_date', 'median_income', 'total_population', 'avg_hhsize', 'avg_community_level', 'county_vote_diff', '2020.student.size']
+    m = 2000
+    train = pd.DataFrame({'ranking': rng.choice(list('abcde'), m), 'Type': rng.choice(['Public', 'Private'], m),
+                          'political_control_state': rng.choice(['Dem', 'Rep', 'Div'], m), 'Region': rng.choice(REGIONS, m),
+                          'announce_date': rng.integers(0, 200, m), 'median_income': rng.normal(30000, 8000, m),
+                          'total_population': rng.integers(1000, 1_000_000, m), 'avg_hhsize': rng.normal(2.5, 0.3, m),
+                          'avg_community_level': rng.random(m)*3, 'county_vote_diff': rng.normal(0, 0.3, m),
+                          '2020.student.size': rng.integers(100, 60000, m)})
+    target = (train['county_vote_diff'] + (train['announce_date'] - 100)/300 + rng.normal(0, 0.3, m)) > 0
+    preprocessor = ColumnTransformer([('one-hot-encoder', OneHotEncoder(handle_unknown='ignore'), categorical_columns),
+                                      ('standard_scaler', StandardScaler(), numerical_columns)])
+    model = Pipeline([('preprocessor', preprocessor), ('classifier', LogisticRegression())]).fit(train, target)
+    joblib.dump(model, os.path.join(directory, 'booster_model.joblib'))
@@ -0,0 +1,173 @@
+"""
+Benchmarks the hot paths of cleaning.py and dash_model.py on synthetic fixtures (see fixtures.py), so they can be measured
+without API keys or multi-GB downloads. Each scale runs in its own process and reports, for every cleaning() stage
+(first reading the csv inputs, then the columnar files made by ingest.py, then the all-counties run) and for the dashboard callback,
+the wall time and peak traced memory, plus the process's peak RSS. Baselines are machine specific, so save one on the
+machine you compare on.
+
+Usage:
+python benchmarks/run.py [--scales small medium] [--save] [--compare] [--baseline benchmarks/baseline.json]
+--save writes the results as the new baseline; --compare reports metrics that got slower or bigger than the baseline
+by more than --tolerance and exits with status 1 if any did.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+
+
+def measure(results, name, func, *args, **kwargs):
+    """
+    Calls func, storing its wall time (seconds) and peak traced memory above what was allocated before the call (MB)
+    in results under name. Returns func's result.
+    """
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    results[f'{name}.seconds'] = round(time.perf_counter() - start, 4)
+    results[f'{name}.peak_mb'] = round((tracemalloc.get_traced_memory()[1] - start_memory)/2**20, 2)
+    return result
+
+
+def run_cleaning(results, label, colleges, census, **kwargs):
+    """
+    Runs cleaning() on a copy of colleges (the booster configuration unless kwargs override it), timing each stage.
+    """
+    import cleaning
+    import stage_cache
+
+    def timed_stage(stage, func, frame, params, sources=(), helpers=()):
+        results[f'{label}.{stage}.rows_in'] = len(frame)
+        result = measure(results, f'{label}.{stage}', func, frame, **params)
+        results[f'{label}.{stage}.rows_out'] = len(result)
+        return result
+
+    run_stage = stage_cache.run_stage
+    stage_cache.run_stage = timed_stage # time every stage and skip the stage cache so all of them run
+    try:
+        kwargs = {'date_cols': ['announce_date'], 'last_tracking_date': '12/06/2021', 'college_name': 'College', **kwargs}
+        result = measure(results, f'{label}.total', cleaning.cleaning, colleges.copy(), census_client=census, **kwargs)
+        results[f'{label}.output_mb'] = round(result.memory_usage(deep=True).sum()/2**20, 3)
+    finally:
+        stage_cache.run_stage = run_stage
+
+
+def run_dashboard(results, num_calls=20):
+    """
+    Times loading the dashboard and update_prediction for new inputs (model runs) and repeated inputs (memoized).
+    """
+    import numpy as np
+    dash_model = measure(results, 'dash.startup', __import__, 'dash_model')
+    rng = np.random.default_rng(0)
+    inputs = [(str(rng.choice(['Public', 'Private'])), int(rng.integers(0, 5)), int(rng.integers(0, 201)), int(rng.integers(0, 701))*100)
+              for _ in range(num_calls)]
+    latencies = []
+    for args in inputs:
+        start = time.perf_counter()
+        dash_model.update_prediction(*args)
+        latencies.append(time.perf_counter() - start)
+    results['dash.update_prediction.mean_ms'] = round(1000*float(np.mean(latencies)), 2)
+    results['dash.update_prediction.p95_ms'] = round(1000*float(np.percentile(latencies, 95)), 2)
+    measure(results, 'dash.update_prediction_repeat', dash_model.update_prediction, *inputs[0])
+
+
+def worker(scale, directory):
+    """
+    Benchmarks one scale inside directory and prints the results as json.
+    """
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+    import fixtures
+    colleges, census, summary = fixtures.write_fixtures(directory, scale)
+    os.chdir(directory)
+    os.environ['covid_cache_dir'] = '.cache'
+    os.environ['covid_offline'] = '1'
+    os.environ.pop('booster_grid', None)
+    tracemalloc.start()
+    results = {f'fixture.{key}': value for key, value in summary.items()}
+
+    run_cleaning(results, 'csv', colleges, census)
+    import ingest
+    for name in ingest.TABLES:
+        measure(results, f'ingest.{name}', ingest.convert, name)
+    ingest.vote_margins.cache_clear()
+    run_cleaning(results, 'columnar', colleges, census)
+    import cleaning
+    counties = cleaning.get_all_counties(fixtures.CENSUS_VARS, census_client=census)
+    run_cleaning(results, 'counties', counties, census, date_cols=None, ignore_college=True, county_fips=True, skip_census=True)
+    results['census.calls'] = census.calls
+
+    run_dashboard(results)
+    tracemalloc.stop()
+    results['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)
+    print(json.dumps(results))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every timing and memory metric next to its baseline value. Returns the metrics that regressed by more than tolerance.
+    """
+    regressions = []
+    for scale, metrics in results.items():
+        for name, value in metrics.items():
+            if not name.endswith(('seconds', 'peak_mb', 'output_mb', '_ms', 'rss_mb')) or name not in baseline.get(scale, {}):
+                continue
+            base = baseline[scale][name]
+            ratio = value/base if base else float('inf') if value else 1.0
+            flag = ''
+            # ignore tiny absolute differences, which are mostly noise
+            if ratio > tolerance and value - base > (0.01 if name.endswith('seconds') else 1):
+                flag = '  <-- regression'
+                regressions.append(f'{scale}.{name}')
+            print(f'{scale:>8} {name:<45} {base:>10} -> {value:>10} ({ratio:.2f}x){flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cleaning.py and dash_model.py on synthetic data.')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], help='fixture sizes to run (small, medium, large)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='json file with saved results')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='ratio above which a metric counts as a regression')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.dir)
+        sys.exit()
+    if args.compare and not os.path.exists(args.baseline):
+        sys.exit(f'No baseline at {args.baseline}; run with --save first (baselines are machine specific).')
+
+    results = {}
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as directory:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', scale, '--dir', directory],
+                                     capture_output=True, text=True)
+        if process.returncode != 0:
+            sys.exit(f'{scale} failed:\n{process.stderr}')
+        results[scale] = json.loads(process.stdout.strip().splitlines()[-1])
+        print(f'{scale}:')
+        for name, value in results[scale].items():
+            print(f'  {name:<45} {value}')
+
+    if args.compare:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+            sys.exit(1)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
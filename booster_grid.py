@@ -0,0 +1,100 @@
+"""
+Precomputes the booster probability of every county for a grid of dashboard inputs (type, ranking, announce date and
+student body size), so dash_model.py can answer callbacks with an array lookup instead of running the model.
+Probabilities are stored as uint8 (probability*255) in a .npy file that is memory-mapped when loaded, with the grid axes
+and county order in a .json file next to it.
+
+The full grid (every slider step) is about 4 GB, so by default announce dates are sampled every 5 days and student body
+sizes every 1000 students; callbacks use the closest grid point.
+
+Usage:
+python booster_grid.py [--date-step 5] [--size-step 1000] [--out booster_grid.npy]
+then start the dashboard with the environment variable 'booster_grid' set to the .npy file.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+TYPES = ['Public', 'Private']
+RANKINGS = [0, 1, 2, 3, 4] # ranking slider values
+MAX_ANNOUNCE_DATE = 200
+MAX_STUDENT_BODY_SIZE = 70000
+SCALE = 255
+
+
+def precompute(model, scenario_features, fips, path='booster_grid.npy', date_step=5, size_step=1000):
+    """
+    Runs the model for every grid point and saves the probabilities with shape (types, rankings, dates, sizes, counties).
+
+    Arguments:
+    model -- fitted sklearn model with predict_proba.
+    scenario_features -- function (type, ranking, announce_date, student_body_size) -> feature dataframe for all counties.
+    fips -- FIPS code of each county, in the order of the rows returned by scenario_features.
+    path -- .npy file to write. The grid axes are written to the same path with a .json extension.
+    date_step, size_step -- spacing of the announce date and student body size axes.
+    """
+    dates = list(range(0, MAX_ANNOUNCE_DATE + 1, date_step))
+    sizes = list(range(0, MAX_STUDENT_BODY_SIZE + 1, size_step))
+    num_counties = len(fips)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    grid = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                     shape=(len(TYPES), len(RANKINGS), len(dates), len(sizes), num_counties))
+    for i, type in enumerate(TYPES):
+        for j, ranking in enumerate(RANKINGS):
+            for k, announce_date in enumerate(dates):
+                # one model call per (type, ranking, date) covering every size and county
+                features = scenario_features(type, ranking, announce_date, 0)
+                features = pd.concat([features]*len(sizes), ignore_index=True)
+                features['2020.student.size'] = np.repeat(sizes, num_counties)
+                proba = model.predict_proba(features)[:, 1].reshape(len(sizes), num_counties)
+                grid[i, j, k] = np.rint(proba*SCALE).astype(np.uint8)
+        logger.info('%s: done', type)
+    grid.flush()
+    del grid
+    os.replace(tmp_path, path)
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'types': TYPES, 'rankings': RANKINGS, 'dates': dates, 'sizes': sizes, 'fips': [int(x) for x in fips]}, f)
+
+
+def load(path, fips=None):
+    """
+    Memory-maps a precomputed grid. Returns the array and its axes.
+
+    Arguments:
+    path -- .npy file written by precompute.
+    fips -- if given, FIPS codes the grid's counties must match (in order), e.g. the dashboard's counties.
+    """
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        axes = json.load(f)
+    if fips is not None and list(axes['fips']) != [int(x) for x in fips]:
+        raise ValueError(f'The counties in {path} do not match the county data; rerun booster_grid.py.')
+    return np.load(path, mmap_mode='r'), axes
+
+
+def lookup(grid, axes, type, ranking, announce_date, student_body_size):
+    """
+    Returns the booster probability of every county at the grid point closest to the given inputs.
+    """
+    i = axes['types'].index(type)
+    j = axes['rankings'].index(ranking)
+    k = int(np.abs(np.asarray(axes['dates']) - announce_date).argmin())
+    l = int(np.abs(np.asarray(axes['sizes']) - student_body_size).argmin())
+    return grid[i, j, k, l].astype(np.float32)/SCALE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute booster probabilities for the dashboard.')
+    parser.add_argument('--date-step', type=int, default=5, help='spacing of announce dates (1 for every slider step)')
+    parser.add_argument('--size-step', type=int, default=1000, help='spacing of student body sizes (100 for every slider step)')
+    parser.add_argument('--out', default='booster_grid.npy')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    import booster_inference
+    booster_inference.load_model()
+    precompute(booster_inference.model, booster_inference.scenario_features, booster_inference.county_features.index,
+               args.out, args.date_step, args.size_step)
@@ -0,0 +1,95 @@
+"""
+Inference for the booster dashboard. Holds the county feature store, builds the model's feature matrix for a set of
+dashboard inputs, and runs a single predict_proba pass whose results are keyed by county FIPS. Recent inputs are memoized,
+so moving a slider back to a previous value doesn't run the model again.
+"""
+from functools import lru_cache
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import ingest
+import reference_data
+from instrumentation import count
+
+# ranking bins used when creating the model (see 'Covid Booster Model')
+RANKING_BINS = [0, 20, 100, 200, 298, 400]
+RANKING_LABELS = ['a', 'b', 'c', 'd', 'e']
+CUTOFF = 0.5
+
+
+def load_county_features():
+    """
+    Builds the county feature store once so callbacks don't have to re-read and re-clean the county data.
+    Note that in Sci-kit learn, the order of the columns matters, so the user-controlled columns ('ranking', 'announce_date', 'Type'
+    and '2020.student.size') are added as placeholders in the positions the model expects.
+    Counties with NaN values are dropped since the model can't predict on them.
+    Returns a dataframe of model features and a dataframe with the map information (padded FIPS, county name, state) for each county,
+    both indexed by the county's integer FIPS code. Treat both as read-only.
+    The county data is created in the __main__ block of cleaning.py and loaded through ingest.py.
+    """
+    college_data = ingest.load_table('college_data_county')
+    # stored as float32, but the model was fit on float64, so convert once here instead of on every predict_proba
+    college_data = college_data.astype({col: 'float64' for col in ingest.FLOAT32_COLUMNS if col in college_data.columns})
+    column_names = college_data.columns
+    college_data[['ranking', 'announce_date', 'Type']] = [RANKING_BINS[0], 0, 'Private']
+    college_data = college_data[['ranking', 'announce_date', 'Type', *column_names]]
+    college_data['ranking'] = pd.cut(college_data['ranking'], bins=RANKING_BINS, labels=RANKING_LABELS, right=False)
+    college_data['STCOUNTYFP_int'] = college_data['STCOUNTYFP']
+    college_data['STCOUNTYFP'] = college_data['STCOUNTYFP'].astype(str).str.zfill(5) # so map can read
+    # county_fips_str and State Code are only in files made before cleaning.py stopped writing them
+    college_data.drop(columns=['state', 'state_fips', 'county_fips_str', 'State Code', 'Division'], errors='ignore', inplace=True)
+    college_data['2020.student.size'] = 0 # this is the last column for my sklearn features, so it also must be last here
+    college_data = college_data.dropna() # drop rows if there are NaN values in any columns
+    college_data.index = pd.Index(college_data['STCOUNTYFP_int'], name='fips')
+
+    county_names = reference_data.read_csv('county_names').drop(columns=['state']).set_index('fips')
+    county_info = college_data[['STCOUNTYFP', 'STCOUNTYFP_int', 'State']].join(county_names, how='left')
+    return college_data.drop(columns='STCOUNTYFP'), county_info
+
+
+county_features, county_info = load_county_features()
+model = None
+
+
+def load_model(path='booster_model.joblib', mmap_mode=None):
+    """
+    Loads the fitted model used by predict_proba.
+    With mmap_mode='r' the model's arrays are memory-mapped from the file (if it was saved uncompressed), so processes forked
+    from this one share a single copy of them.
+    """
+    global model
+    model = joblib.load(path, mmap_mode=mmap_mode)
+    predict_proba.cache_clear()
+    return model
+
+
+def scenario_features(type, ranking, announce_date, student_body_size):
+    """
+    Returns a copy of the county feature store with the user-controlled columns set to the given values.
+    """
+    college_data = county_features.copy()
+    college_data['ranking'] = pd.cut(np.full(college_data.shape[0], ranking), bins=RANKING_BINS, labels=RANKING_LABELS, right=False)  # cut the ranking into 5 bins
+    college_data['announce_date'] = announce_date
+    college_data['Type'] = type
+    college_data['2020.student.size'] = student_body_size
+    return college_data
+
+
+@lru_cache(maxsize=256)
+def predict_proba(type, ranking, announce_date, student_body_size):
+    """
+    Returns the booster probability of every county for the given dashboard inputs, as a series indexed by FIPS.
+    The result is shared between calls with the same inputs, so don't modify it.
+    """
+    count('model.predict_proba') # only counted when the inputs aren't memoized
+    proba = model.predict_proba(scenario_features(type, ranking, announce_date, student_body_size))[:, 1]
+    return pd.Series(proba, index=county_features.index, name='Booster Probability')
+
+
+def booster_label(proba):
+    """
+    Returns true where the booster probability is above the cutoff, the same label model.predict gives.
+    """
+    return proba > CUTOFF
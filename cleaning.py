@@ -1,15 +1,227 @@
+import argparse
 import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
-from census import Census
 import os
-import us
-import requests
+import json
+import hashlib
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import math
-import nltk
-import re
-import string
-from collections import Counter
+import logging
+import reference_data
+import ingest
+import stage_cache
+import instrumentation
+from instrumentation import count
+
+# census, us, requests and name_matching (nltk, sklearn) are slow to import, so they are imported by the functions that
+# use them; runs that skip the census or the college matching never load them
+logger = logging.getLogger(__name__)
+CENSUS_ALL = '*' # census.Census.ALL
+ALL_COUNTIES = 'all_counties' # input name for the frame made by get_all_counties
+
+
+def get_census_counties(census_vars, year=2020, census_client=None, refresh=False):
+    """
+    Returns the ACS5 census data for every US county with a single API call, as a dataframe with a column for each
+    census var (renamed using census_vars) and the 'state' and 'county' FIPS codes as zero-padded strings.
+    Results of the census API are cached on disk keyed by the variables and year, so reruns with the same arguments make no
+    API calls. Results of a census_client are never cached, so they can't be mistaken for real data later.
+
+    Arguments:
+    census_vars -- dictionary with codes and names of corresponding census variables from the US Census Bureau's ASC5 survey.
+    year -- year of the ACS5 survey.
+    census_client -- client to use instead of census.Census (e.g., a stub for testing). Must have acs5.state_county.
+    refresh -- true to call the API even if the result is cached.
+    """
+    census_var_names = list(census_vars.keys())
+    key = hashlib.sha256(json.dumps([sorted(census_var_names), year]).encode()).hexdigest()[:16]
+    cache_path = reference_data.cache_dir('census', f'acs5_{year}_{key}.pkl')
+    if census_client is None and os.path.exists(cache_path) and not refresh:
+        count('census.cache_hits')
+        census_counties = pd.read_pickle(cache_path)
+    else:
+        use_cache = census_client is None
+        if census_client is None:
+            if reference_data.is_offline():
+                raise FileNotFoundError(f'Census data for {census_var_names} ({year}) is not cached and offline mode is on.')
+            from census import Census
+            census_client = Census(os.getenv('api_key_census'), year=year)
+        count('census.calls')
+        api_return = census_client.acs5.state_county(census_var_names, CENSUS_ALL, CENSUS_ALL) # list of dicts, one per county
+        census_counties = pd.DataFrame(api_return, columns=census_var_names + ['state', 'county'])
+        if use_cache:
+            census_counties.to_pickle(f'{cache_path}.tmp', compression=None)
+            os.replace(f'{cache_path}.tmp', cache_path)
+    return census_counties.rename(columns=census_vars)
+
+
+def get_census_by_county(census_vars, census_client=None):
+    """
+    Returns the census data of get_census_counties indexed by the integer county FIPS code ('STCOUNTYFP'),
+    with the census vars as float32, so it can be joined to a dataframe with an indexed lookup.
+
+    Arguments:
+    census_vars -- dictionary with codes and names of corresponding census variables from the US Census Bureau's ASC5 survey.
+    census_client -- client to use instead of census.Census (e.g., a stub for testing). Must have acs5.state_county.
+    """
+    census_counties = get_census_counties(census_vars, census_client=census_client)
+    fips = pd.Index((census_counties['state'] + census_counties['county']).astype('int32'), name='STCOUNTYFP')
+    census_counties = census_counties.drop(columns=['state', 'county']).apply(pd.to_numeric, errors='coerce')
+    return census_counties.astype('float32').set_axis(fips)
+
+
+def get_all_counties(census_vars={'B07011_001E': 'median_income', 'B01003_001E': 'total_population', 'B25010_003E': 'avg_hhsize'},
+                     census_client=None):
+    """
+    Returns a dataframe with one row per US county holding its census vars and the columns cleaning() expects with county_fips=True
+    and skip_census=True ('state_fips', 'state' and the integer 'STCOUNTYFP'). Used to build college_data_county.csv.
+
+    Arguments:
+    census_vars -- dictionary with codes and names of corresponding census variables from the US Census Bureau's ASC5 survey.
+    census_client -- client to use instead of census.Census (e.g., a stub for testing). Must have acs5.state_county.
+    """
+    import us
+    counties = get_census_by_county(census_vars, census_client=census_client).reset_index()
+    counties['state_fips'] = (counties['STCOUNTYFP']//1000).astype('int8')
+    state_abbr = {int(fips): abbr for fips, abbr in us.states.mapping('fips', 'abbr').items() if fips}
+    counties['state'] = counties['state_fips'].map(state_abbr).astype('category')
+    return counties[[*census_vars.values(), 'state_fips', 'state', 'STCOUNTYFP']]
+
+
+def get_community_levels(fips, last_tracking_date, chunksize=None):
+    """
+    Returns the average CAN community level (missing days count as 0) of each county before last_tracking_date, indexed by fips.
+    The timeseries is read in chunks (record batches of its memory-mapped columnar file if converted by ingest.py) with only the needed columns, and each chunk is filtered by date and county before
+    being added to running sums and counts, so peak memory doesn't depend on the size of the file.
+
+    Arguments:
+    fips -- county FIPS codes to keep.
+    last_tracking_date -- date before which to track all COVID data.
+    chunksize -- number of rows to read at a time from the csv. Defaults to the one in ingest.TABLES.
+    """
+    level_col = 'communityLevels.canCommunityLevel'
+    fips = pd.unique(pd.Series(fips).dropna())
+    last_tracking_date = pd.Timestamp(last_tracking_date)
+    sums = []
+    counts = []
+    for chunk in ingest.iter_table('counties_timeseries', columns=['fips', 'date', level_col], chunksize=chunksize):
+        chunk = chunk[chunk['fips'].isin(fips)]
+        chunk = chunk[chunk['date'] < last_tracking_date]
+        grouped = chunk[level_col].fillna(0).groupby(chunk['fips'])
+        sums.append(grouped.sum())
+        counts.append(grouped.size())
+    if not sums:
+        return pd.Series(dtype=float, index=pd.Index([], name='fips'), name=level_col)
+    sums = pd.concat(sums).groupby(level=0).sum()
+    counts = pd.concat(counts).groupby(level=0).sum()
+    return (sums/counts).rename_axis('fips')
+
+
+def lookup_columns(df, key, table, suffixes=('_x', '_y')):
+    """
+    Left joins table to df as an indexed lookup: adds the columns of table to df in place (without copying df),
+    taking for each row the table row whose index equals df[key], or NaN if there is none. Returns df.
+
+    Arguments:
+    df -- dataframe to add the columns to.
+    key -- column of df to look up.
+    table -- dataframe with a unique index of the same type as df[key].
+    suffixes -- suffixes added to the columns of df and table that have the same name, like in pd.merge.
+    """
+    matched = table.reindex(df[key].to_numpy()).set_axis(df.index) # keeps dtypes such as categoricals
+    overlap = df.columns.intersection(table.columns)
+    df.rename(columns={col: f'{col}{suffixes[0]}' for col in overlap}, inplace=True)
+    for col in table.columns:
+        df[f'{col}{suffixes[1]}' if col in overlap else col] = matched[col]
+    return df
+
+
+SCORECARD_URL = 'https://api.data.gov/ed/collegescorecard/v1/schools'
+
+def get_scorecard_data(scorecard_vars, api_key=None, workers=4, per_page=100, max_retries=5, refresh=False, rate_limit_pause=60):
+    """
+    Returns every school in the US Dept of Education College Scorecard with its id, name, zip and the given scorecard vars.
+    Pages are fetched by a bounded pool of worker threads, each reusing its own connection. Requests that fail with a 429 or 5xx
+    are retried with exponential backoff (or after the Retry-After header), and every worker pauses when the rate limit is hit
+    or when the X-RateLimit-Remaining header shows fewer calls left than there are workers, so they don't run into 429s.
+    Each page is saved to disk as soon as it arrives, so an interrupted pull resumes where it left off and a finished one is
+    reused without calling the API.
+
+    Arguments:
+    scorecard_vars -- dictionary with codes and names of corresponding variables from the US Dept of Education College Scorecard.
+    api_key -- College Scorecard API key. Defaults to the 'api_key_scorecard' environment variable.
+    workers -- maximum number of pages to fetch at the same time.
+    per_page -- number of schools per page (the API allows at most 100).
+    max_retries -- number of times to retry a page before giving up.
+    refresh -- true to discard saved pages and fetch everything again.
+    rate_limit_pause -- seconds every worker waits when the rate limit is almost used up (the API's limit is a rolling window,
+    so calls become available again gradually). The X-RateLimit-Reset header is used instead when the API sends it.
+    """
+    import requests
+    api_key = api_key or os.getenv('api_key_scorecard')
+    fields = ','.join(['id', 'school.name', 'school.zip', *scorecard_vars.values()])
+    key = hashlib.sha256(f'{fields}|{per_page}'.encode()).hexdigest()[:16]
+    meta_path = reference_data.cache_dir('scorecard', key, 'metadata.json')
+    page_dir = os.path.dirname(meta_path)
+    if refresh:
+        shutil.rmtree(page_dir)
+        os.makedirs(page_dir)
+    local = threading.local()
+    paused_until = [0.0] # shared by all workers so they back off together when rate limited
+
+    def request(endpoint, params):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        if reference_data.is_offline():
+            raise FileNotFoundError('College Scorecard pages are not cached and offline mode is on.')
+        params = {'fields': fields, 'per_page': per_page, 'api_key': api_key, **params}
+        for attempt in range(max_retries + 1):
+            time.sleep(max(0, paused_until[0] - time.time()))
+            count('scorecard.requests')
+            try:
+                response = local.session.get(f'{SCORECARD_URL}.{endpoint}', params=params, timeout=60)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+                time.sleep(2**attempt)
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt == max_retries:
+                    response.raise_for_status()
+                retry_after = response.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.isdigit() else 2**attempt
+                paused_until[0] = max(paused_until[0], time.time() + delay)
+                continue
+            response.raise_for_status()
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining is not None and int(remaining) <= workers:
+                reset = response.headers.get('X-RateLimit-Reset', '')
+                delay = float(reset) if reset.isdigit() else rate_limit_pause
+                logger.warning('Only %s College Scorecard API calls left in the current rate limit window; pausing for %.1fs.',
+                               remaining, delay)
+                paused_until[0] = max(paused_until[0], time.time() + delay)
+            return response
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            total = json.load(f)['total']
+    else:
+        total = request('json', {'page': 0}).json()['metadata']['total']
+        reference_data.write_atomic(meta_path, json.dumps({'total': total, 'fields': fields}).encode())
+
+    def fetch_page(page_num):
+        page_path = os.path.join(page_dir, f'page_{page_num}.csv')
+        if os.path.exists(page_path):
+            count('scorecard.cache_hits')
+        else:
+            reference_data.write_atomic(page_path, request('csv', {'page': page_num}).content)
+        return page_path
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        page_paths = list(executor.map(fetch_page, range(math.ceil(total/per_page))))
+    return pd.concat([pd.read_csv(page_path) for page_path in page_paths], ignore_index=True)
 
 
 def cleaning(covid_dates, date_cols=['Spring2020', 'FirstVaccine', 'Booster', 'Spring2022'], 
@@ -21,7 +233,11 @@ def cleaning(covid_dates, date_cols=['Spring2020', 'FirstVaccine', 'Booster', 'S
              college_name='name',
              ignore_college=False,
              county_fips=False,
-             skip_census=False):
+             skip_census=False,
+             census_client=None,
+             match_threshold=0.0,
+             use_stage_cache=True,
+             report_path=None):
     """  
     Given dataframe with zip code (and no state column) will find census data for given variables and corresponding county-level covid data, 
     as well as political leaning of both the county and state. If zip code not found, will set it to NaN.
@@ -42,219 +258,175 @@ def cleaning(covid_dates, date_cols=['Spring2020', 'FirstVaccine', 'Booster', 'S
     ignore_college -- true to ignore all data obtained from specific college. Must be inputed individually by user instead.
     county_fips -- true if using county fips data instead of zip codes. Column name in covid_dates must be 'STCOUNTYFP'.
     skip_census -- true if not calling the get_census method.
+    census_client -- client to use instead of census.Census (e.g., a stub for testing). Must have acs5.state_county.
+    match_threshold -- minimum cosine similarity between a college name and a College Scorecard name in the same zip code for them to match.
+    use_stage_cache -- true to reuse the output of each stage saved by a previous run with the same inputs (see stage_cache.py).
+    report_path -- json file to write a run report to, with the wall time, rows in and out, fan-out, peak RSS, remote calls
+                    and cache hits of each stage (see instrumentation.py). These are logged either way.
     """
+    covid_dates = covid_dates.copy(deep=False) # the stages add columns in place, but not to the caller's dataframe
     if date_cols is not None:
         covid_dates_only_d = covid_dates[date_cols].apply(pd.to_datetime) # ensure date columns in datetime format        
         first_dates = covid_dates_only_d.min()             
         date_diff = covid_dates_only_d - first_dates
         covid_dates[date_cols] = date_diff.apply(lambda x: x.dt.days)
 
+    # All joins below are lookups on integer keys (int32 FIPS and zip codes), adding columns to the stage's dataframe
+    # instead of merging it into a new one.
     def get_census(covid_dates_cleaned, census_vars, county_fips):        
-        census_api_key = os.getenv('api_key_census')
-        c = Census(census_api_key, year=2020)
-        state_fips = us.states.mapping('abbr', 'fips')
         if not county_fips:                               
-            county_zips = pd.read_csv('zip-county-fips/ZIP-COUNTY-FIPS_2017-06.csv')
-            if 'state' in covid_dates.columns:
-                covid_dates_cleaned = covid_dates_cleaned.merge(county_zips[["ZIP", "STATE", "STCOUNTYFP"]], left_on=["zip"], right_on=["ZIP"]).drop(columns=["STATE", "ZIP"])
-            else:
-                covid_dates_cleaned = covid_dates_cleaned.merge(county_zips[["ZIP", "STATE", "STCOUNTYFP"]], left_on=["zip"], right_on=["ZIP"]).drop(columns=["ZIP"])
-        else:
-            covid_dates_cleaned = covid_dates
+            county_zips = ingest.load_table('zip_county', columns=['ZIP', 'STATE', 'STCOUNTYFP']).set_index('ZIP')
+            if 'state' in covid_dates_cleaned.columns:
+                county_zips = county_zips.drop(columns='STATE')
+            # a zip code can be in several counties, so this is a merge (one row per college and county) rather than a lookup;
+            # only the keys are merged, and the matching rows are then taken by position
+            zips = pd.to_numeric(covid_dates_cleaned['zip'], errors='coerce').astype('Int32').reset_index(drop=True)
+            zip_counties = zips.to_frame('ZIP').merge(county_zips, left_on='ZIP', right_index=True).drop(columns='ZIP')
+            covid_dates_cleaned = covid_dates_cleaned.iloc[zip_counties.index].reset_index(drop=True)
+            for col in zip_counties.columns:
+                covid_dates_cleaned[col] = zip_counties[col].array
         covid_dates_cleaned.rename(columns={'STATE': 'state'}, inplace=True)                
-        covid_dates_cleaned['state_fips'] = covid_dates_cleaned['state'].map(state_fips)                    
-        covid_dates_cleaned["county_fips"] = covid_dates_cleaned["STCOUNTYFP"]%1000
-        covid_dates_cleaned['county_fips_str'] = covid_dates_cleaned['county_fips'].astype(str).str.zfill(3)
-        api_return_cols = list(census_vars.values()) + ['state', 'county']
-        def separate_county_fips(x, *v):    
-            """
-            Given a row of data, will return the census data corresponding to census vars for the county and state.
-            """
-            api_return = c.acs5.state_county(v, x[0], x[1]) # returns dict in a list if found; empty list if not    
-            try:
-                api_return_clean = pd.Series(api_return[0])
-                return api_return_clean.rename(census_vars) 
-            except:
-                no_api_return = pd.Series(index=api_return_cols, dtype='object')
-                no_api_return[['state', 'county']] = x.values
-                return no_api_return
-        census_var_names = list(census_vars.keys())
-        census_vars_counties = covid_dates_cleaned[['state_fips', 'county_fips_str']].drop_duplicates().apply(separate_county_fips, args=(census_var_names), axis=1)              
-        covid_dates_cleaned = (covid_dates_cleaned.merge(census_vars_counties, 
-                                                left_on=['state_fips', 'county_fips_str'], 
-                                                right_on=['state', 'county'],
-                                                suffixes=('', '_new'))
-                                .drop(columns=['county']))
-        return covid_dates_cleaned        
+        covid_dates_cleaned['state_fips'] = (covid_dates_cleaned['STCOUNTYFP']//1000).astype('int8')
+        covid_dates_cleaned["county_fips"] = (covid_dates_cleaned["STCOUNTYFP"]%1000).astype('int16')
+        census_vars_counties = get_census_by_county(census_vars, census_client=census_client) # one call for all counties instead of one per row
+        return lookup_columns(covid_dates_cleaned, 'STCOUNTYFP', census_vars_counties, suffixes=('', '_new'))
 
     def get_covid_county(covid_dates_cleaned, last_tracking_date):
-        covid_county = pd.read_csv('counties.timeseries.csv')
-        covid_county_present = covid_county.merge(covid_dates_cleaned['STCOUNTYFP'], left_on='fips', right_on='STCOUNTYFP', how='right')
-        covid_county_present['date'] = pd.to_datetime(covid_county_present['date'])        
-        covid_county_present = covid_county_present.query("date < @last_tracking_date").copy()
-        covid_county_present[['communityLevels.canCommunityLevel']] = covid_county_present[['communityLevels.canCommunityLevel']].fillna(0)
-        community_levels = covid_county_present.groupby('fips')['communityLevels.canCommunityLevel'].mean()
-        covid_dates_cleaned = covid_dates_cleaned.merge(community_levels.rename('avg_community_level'), left_on='STCOUNTYFP', right_on='fips', how='left')
-        return covid_dates_cleaned
+        community_levels = get_community_levels(covid_dates_cleaned['STCOUNTYFP'], last_tracking_date)
+        community_levels = community_levels.astype('float32').to_frame('avg_community_level')
+        return lookup_columns(covid_dates_cleaned, 'STCOUNTYFP', community_levels)
 
     def get_political_lean(covid_dates_cleaned, election_year):
         political_control_state = {'DC': 'Dem', 'AL': 'Rep', 'AK': 'Rep', 'AZ': 'Rep', 'AR': 'Rep', 'CA': 'Dem', 'CO': 'Dem', 'CT': 'Dem', 'DE': 'Dem', 'FL': 'Rep', 'GA': 'Rep', 'HI': 'Dem', 'ID': 'Rep', 'IL': 'Dem', 'IN': 'Rep', 'IA': 'Rep', 'KS': 'Div', 'KY': 'Div', 'LA': 'Div', 'ME': 'Dem', 'MD': 'Div', 'MA': 'Div', 'MI': 'Div', 'MN': 'Div', 'MS': 'Rep', 'MO': 'Rep', 'MT': 'Div', 'NE': 'Rep', 'NV': 'Dem', 'NH': 'Div', 'NJ': 'Dem', 'NM': 'Dem', 'NY': 'Dem', 'NC': 'Div', 'ND': 'Rep', 'OH': 'Rep', 'OK': 'Rep', 'OR': 'Dem', 'PA': 'Div', 'RI': 'Dem', 'SC': 'Rep', 'SD': 'Rep', 'TN': 'Rep', 'TX': 'Rep', 'UT': 'Rep', 'VT': 'Div', 'VA': 'Dem', 'WA': 'Dem', 'WV': 'Rep', 'WI': 'Div', 'WY': 'Rep'}
-        print(covid_dates_cleaned)
-        covid_dates_cleaned['political_control_state'] = covid_dates_cleaned['state'].map(political_control_state)
-        county_pres = pd.read_csv('political-data/countypres_2000-2020.csv')        
-        county_pres = county_pres.query("year == @election_year")
-        county_pres = county_pres.dropna(subset=['county_fips'])
-        county_pres['county_fips'] = county_pres['county_fips'].astype(int, copy=False)
-        county_pres['percentvote'] = county_pres['candidatevotes']/county_pres['totalvotes']
-        county_pres = county_pres.query("(party == 'REPUBLICAN' or party == 'DEMOCRAT') and mode == 'TOTAL'")
-        county_pres_percents = (county_pres.query("party == 'DEMOCRAT'")[['county_fips', 'percentvote']]
-                                .merge(county_pres.query("party == 'REPUBLICAN'")[['county_fips', 'percentvote']], 
-                                        on='county_fips', suffixes=('_D', '_R')))
-        county_pres_percents['county_vote_diff'] = county_pres_percents['percentvote_D'] - county_pres_percents['percentvote_R']
-        county_pres_percents['STCOUNTYFP'] = county_pres_percents['county_fips'].astype(str)
-        covid_dates_cleaned['STCOUNTYFP'] = covid_dates_cleaned['STCOUNTYFP'].astype(str)
-        covid_dates_all = covid_dates_cleaned.merge(county_pres_percents[['STCOUNTYFP', 'county_vote_diff']], on='STCOUNTYFP', how='left')
-        return covid_dates_all
+        logger.debug('Adding political lean to:\n%s', covid_dates_cleaned)
+        covid_dates_cleaned['political_control_state'] = covid_dates_cleaned['state'].map(political_control_state).astype('category')
+        vote_margins = ingest.vote_margins()
+        if election_year not in vote_margins.columns:
+            raise ValueError(f'No county presidential returns for {election_year}; available years are {list(vote_margins.columns)}.')
+        covid_dates_cleaned['county_vote_diff'] = covid_dates_cleaned['STCOUNTYFP'].map(vote_margins[election_year]).astype('float32')
+        return covid_dates_cleaned
 
     def get_region(covid_dates_all):
-        census_regions = pd.read_csv('https://raw.githubusercontent.com/cphalpert/census-regions/master/us%20census%20bureau%20regions%20and%20divisions.csv')
-        covid_dates_all = (covid_dates_all.merge(census_regions, left_on='state', right_on='State Code', how='left'))                    
-        return covid_dates_all
+        census_regions = reference_data.read_csv('census_regions', index_col='State Code').astype('category')
+        return lookup_columns(covid_dates_all, 'state', census_regions)
 
-    def get_school_data(covid_dates_all, call_scoreboard_api, scorecard_vars):
+    def get_school_data(covid_dates_all, call_scoreboard_api, scorecard_vars, college_name, match_threshold):
+        import name_matching
         if call_scoreboard_api:
-            api_key_scorecard = os.getenv('api_key_scorecard')
-            readable_fields = ','.join(scorecard_vars.values())
-            url = f'https://api.data.gov/ed/collegescorecard/v1/schools.json?fields=id,school.name,school.zip,{readable_fields}&api_key={api_key_scorecard}'
-            r = requests.get(url)
-            r = r.json()
-            total_page_nums = r['metadata']['total']/r['metadata']['per_page']
-            scoreboard_data = []
-            for page_num in range(math.ceil(total_page_nums)):
-                url = f'https://api.data.gov/ed/collegescorecard/v1/schools.csv?fields=id,school.name,school.zip,2020.student.size&page={page_num}&api_key={api_key_scorecard}'
-                scoreboard_data.append(pd.read_csv(url))
-            scoreboard_data_all = pd.concat(scoreboard_data)
-            scoreboard_data_all.reset_index(drop=True, inplace=True)
-
-            # clean zip (disregard last 4 digits)
-            scoreboard_data_all['school.zip'] = scoreboard_data_all['school.zip'].astype(str)
-            scoreboard_data_all['school.zip'] = scoreboard_data_all['school.zip'].str.extract(r'^(\d+)')
-            def separate_connected_zips(x):
-                """
-                Get first 5 digits of zip if full zip exists and is not separated by a '-'.
-                """    
-                if len(x) == 9:
-                    return x[:5]
-                return x.lstrip('0') # because all the previous zip codes I've worked with also ignored leading 0s
-            scoreboard_data_all['school.zip'] = scoreboard_data_all['school.zip'].apply(separate_connected_zips)
+            scoreboard_data_all = get_scorecard_data(scorecard_vars)
+
+            # clean zip (disregard last 4 digits): get first 5 digits of zip if full zip exists and is not separated by a '-'
+            school_zips = scoreboard_data_all['school.zip'].astype(str).str.extract(r'^(\d+)')[0]
+            school_zips = school_zips.where(school_zips.str.len() != 9, school_zips.str[:5])
+            scoreboard_data_all['school.zip'] = pd.to_numeric(school_zips, errors='coerce').astype('Int32')
         else:
-            scoreboard_data_all = pd.read_csv('scoreboard_size.csv')
-            scoreboard_data_all['school.zip'] = scoreboard_data_all['school.zip'].astype(str)
-
-
-        covid_dates_all['zip_str'] = covid_dates_all['zip'].astype(str) # need str to do merging
-        stopwords = nltk.corpus.stopwords.words('english')
-        stopwords.extend(['university', 'college', 'main', 'campus'])
-        def clean_name(x, is_list=False):
-            text = re.sub('-', ' ', x) # dashes in data -- need to add spaces and remove
-            text = text.split(' ') # remove excess spaces
-            text = ' '.join(text)
-            text = ''.join([i.lower() for i in text if i not in string.punctuation])
-            text = nltk.tokenize.word_tokenize(text)    
-            text = [i for i in text if i not in stopwords] # lower all
-            text = text if is_list else ' '.join(text)    
-            return text
-        covid_dates_all['cleaned_name_list'] = covid_dates_all[college_name].apply(lambda x: clean_name(x, True))
-        scoreboard_data_all['cleaned_school.name_list'] = scoreboard_data_all['school.name'].apply(lambda x: clean_name(x, True))
-        # merge on zips and partially on names (keep name in scoreboard data that's closest in cosine similarity to the one in covid_dates_all)
-        covid_dates_all_zips = covid_dates_all.merge(scoreboard_data_all, left_on='zip_str', right_on='school.zip', how='left')
-        def cosine_similarity(l1, l2):
-            """
-            Copied from Martijn Pieters's answer in 
-            https://stackoverflow.com/questions/14720324/compute-the-similarity-between-two-lists
-            """
-            c1 = Counter(l1)
-            c2 = Counter(l2)
-            terms = set(c1).union(c2)
-            dotprod = sum(c1.get(k, 0) * c2.get(k, 0) for k in terms)
-            magA = math.sqrt(sum(c1.get(k, 0)**2 for k in terms))
-            magB = math.sqrt(sum(c2.get(k, 0)**2 for k in terms))
-            return dotprod / (magA * magB)
-        old_num = covid_dates_all_zips[college_name].unique().shape[0]
-        covid_dates_all_zips.dropna(subset=['2020.student.size'], inplace=True)
-        new_num = covid_dates_all_zips[college_name].unique().shape[0]
+            scoreboard_data_all = ingest.load_table('scoreboard_size') # zips are already Int32 (see ingest.TABLES)
+
+        # match on zips and partially on names (keep name in scoreboard data that's closest in cosine similarity to the one in covid_dates_all)
+        scoreboard_data_all = scoreboard_data_all.dropna(subset=list(scorecard_vars.values())).reset_index(drop=True)
+        matches = name_matching.match_names(covid_dates_all[college_name].fillna(''),
+                                            pd.to_numeric(covid_dates_all['zip'], errors='coerce').astype('Int32'),
+                                            scoreboard_data_all['school.name'].fillna(''), scoreboard_data_all['school.zip'],
+                                            threshold=match_threshold)
+        matched_names = covid_dates_all[college_name].iloc[matches['left']].reset_index(drop=True)
+        old_num = covid_dates_all[college_name].unique().shape[0]
+        new_num = matched_names.unique().shape[0]
         perc_dropped = 1 - new_num/old_num
-        print(f'Note that {perc_dropped*100}% of samples have been dropped due to automated college searching for the college scoreboard.')
-        covid_dates_all_zips['name_similarity'] = covid_dates_all_zips.apply(lambda x: cosine_similarity(x['cleaned_name_list'], x['cleaned_school.name_list']), axis=1)
-        covid_dates_all = covid_dates_all_zips.loc[covid_dates_all_zips.groupby(college_name)['name_similarity'].idxmax().values] # keep only college in zip code with highest similarty
+        logger.info('Note that %s%% of samples have been dropped due to automated college searching for the college scoreboard.', perc_dropped*100)
+        # keep only college in zip code with highest similarty, then copy just those rows of both tables
+        best = matches.loc[matches['name_similarity'].groupby(matched_names).idxmax().values]
+        covid_dates_all = (covid_dates_all.iloc[best['left']].set_axis(best.index)
+                           .join(scoreboard_data_all.iloc[best['right']].set_axis(best.index), lsuffix='_x', rsuffix='_y'))
+        covid_dates_all['name_similarity'] = best['name_similarity']
         return covid_dates_all
 
     # try:
-    if not skip_census:
-        covid_dates = get_census(covid_dates, census_vars, county_fips)    
-    covid_dates = get_covid_county(covid_dates, last_tracking_date)    
-    covid_dates = get_political_lean(covid_dates, election_year)    
-    covid_dates = get_region(covid_dates)
-    if not ignore_college:
-        covid_dates = get_school_data(covid_dates, call_scoreboard_api, scorecard_vars)
+    stages = []
+    def run_stage(stage, func, covid_dates, sources=(), helpers=(), **params):
+        with instrumentation.timed(stage, stages, rows_in=len(covid_dates)) as record:
+            if use_stage_cache:
+                covid_dates = stage_cache.run_stage(stage, func, covid_dates, params, sources, helpers)
+            else:
+                covid_dates = func(covid_dates, **params)
+            record['rows_out'] = len(covid_dates)
+        return covid_dates
+
+    with instrumentation.timed('cleaning', stages, rows_in=len(covid_dates)) as record:
+        if not skip_census:
+            covid_dates = run_stage('census', get_census, covid_dates, ['zip_county'],
+                                    [get_census_by_county, get_census_counties, lookup_columns, ingest],
+                                    census_vars=census_vars, county_fips=county_fips)
+        covid_dates = run_stage('covid_county', get_covid_county, covid_dates, ['counties_timeseries'],
+                                [get_community_levels, lookup_columns, ingest], last_tracking_date=last_tracking_date)
+        covid_dates = run_stage('political_lean', get_political_lean, covid_dates, ['county_pres'], [ingest], election_year=election_year)
+        covid_dates = run_stage('region', get_region, covid_dates, ['census_regions'], [lookup_columns, reference_data])
+        if not ignore_college:
+            covid_dates = run_stage('school', get_school_data, covid_dates, [] if call_scoreboard_api else ['scoreboard_size'],
+                                    [get_scorecard_data, ingest, 'name_matching'],
+                                    call_scoreboard_api=call_scoreboard_api, scorecard_vars=scorecard_vars,
+                                    college_name=college_name, match_threshold=match_threshold)
+        record['rows_out'] = len(covid_dates)
+    if report_path is not None:
+        report = {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - record['seconds'])),
+                  'stages': stages[:-1], 'total': stages[-1]}
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        reference_data.write_atomic(report_path, json.dumps(report, indent=2, default=str).encode())
     return covid_dates
     # except:
     #     print('All zips not found.')
     #     return covid_dates
 
+
+def clean_file(input_path, output_path, **kwargs):
+    """
+    Runs cleaning() on a csv and writes the result to output_path atomically, so an interrupted run never leaves a partial file.
+    Returns the number of rows written.
+
+    Arguments:
+    input_path -- csv to clean, or ALL_COUNTIES for the frame made by get_all_counties (with the census vars in kwargs).
+    output_path -- csv to write.
+    kwargs -- other arguments of cleaning().
+    """
+    if input_path == ALL_COUNTIES:
+        covid_dates = get_all_counties(**{key: kwargs[key] for key in ('census_vars', 'census_client') if key in kwargs})
+    else:
+        covid_dates = pd.read_csv(input_path)
+    covid_dates = cleaning(covid_dates, **kwargs)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    reference_data.write_atomic(output_path, covid_dates.to_csv(index=False).encode())
+    return len(covid_dates)
+
+
 if __name__ == '__main__':
-    # use to test the dataset I created
-    # covid_dates = pd.read_csv('covid_dates_nice.csv') # after basic cleaning applied to my excel file    
-    # covid_dates = cleaning(covid_dates)    
-    # covid_dates.to_csv('covid_dates_cleaned_script_school.csv', index=False) 
-
-    # use for normal vaccination status inquiries
-    # covid_dates = pd.read_csv('vacc_mandates_top.csv') 
-    # covid_dates = cleaning(covid_dates, date_cols=['announce_date'], last_tracking_date='3/25/2021', college_name='College')    
-    # covid_dates.to_csv('vacc_mandates_cleaned_school.csv', index=False)
-
-    # use for boosters -- changed last tracking date to the earliest booster day I found in my dataset because the other set only tracks vaccine mandates
-    # covid_dates = pd.read_csv('vacc_mandates_top.csv')   
-    # covid_dates = cleaning(covid_dates, date_cols=['announce_date'], last_tracking_date='12/06/2021', college_name='College')    
-    # covid_dates.to_csv('booster_mandates_cleaned_school.csv', index=False)    
-        
-    # Get county-level values for all counties--can't do all at once because of API limits
-    # county_zips = pd.read_csv('zip-county-fips/ZIP-COUNTY-FIPS_2017-06.csv')
-    # n = 100 # number of times to call API
-    # college_data = county_zips[['STCOUNTYFP', 'STATE']].drop_duplicates() #.head(n)
-    
-    # Get all counties from Census API and add necessary columns to run with method
-    # census_api_key = os.getenv('api_key_census')
-    # c = Census(census_api_key, year=2020)
-    # census_vars={'B07011_001E': 'median_income', 'B01003_001E': 'total_population', 'B25010_003E': 'avg_hhsize'}
-    # census_var_names = list(census_vars.keys())
-    # api_return = c.acs5.state_county(census_var_names, Census.ALL, Census.ALL)
-    # api_return_clean = pd.DataFrame(api_return)    
-    # api_return_clean = api_return_clean.rename(columns=census_vars)
-    # api_return_clean = api_return_clean.rename(columns={'state': 'state_fips', 'county': 'county_fips_str'})
-    # state_fips = us.states.mapping('fips', 'abbr')
-    # api_return_clean['state'] = api_return_clean['state_fips'].map(state_fips)    
-    # api_return_clean['STCOUNTYFP'] = (api_return_clean['state_fips'] + api_return_clean['county_fips_str']).astype(int)      
-    # # Get remaining data  
-    # last_tracking_date = '12/06/2021' # for booster
-    # college_data = cleaning(api_return_clean, date_cols=None, last_tracking_date=last_tracking_date, ignore_college=True, county_fips=True, skip_census=True)
-    # college_data.to_csv('college_data_county.csv', index=False)
-    
-    import joblib
-    ranking = 1
-    announce_date = 2
-    type = 'Public'
-    student_body_size = 2000
-    model = joblib.load('booster_model_jlib')
-    college_data = pd.read_csv('college_data_county.csv')
-    column_names = college_data.columns
-    college_data[['ranking', 'announce_date', 'Type']] = [ranking, announce_date, type]
-    college_data = college_data[['ranking', 'announce_date', 'Type', *column_names]]
-    college_data['ranking'] = pd.cut(college_data['ranking'], bins=[0, 20, 100, 200, 298, 400], labels=['a', 'b', 'c', 'd', 'e'], right=False)  # cut the ranking into 5 bins
-    college_data_clean = college_data #.drop(columns=['state', 'state_new', 'STCOUNTYFP', 'state_fips', 'county_fips', 'county_fips_str', 'State', 'State Code', 'Division'])  
-    college_data_clean['STCOUNTYFP'] = college_data_clean['STCOUNTYFP'].astype(str).str.zfill(5) # so map can read
-    college_data_clean.drop(columns=['state', 'state_fips', 'county_fips_str', 'State', 'State Code', 'Division'], 
-            inplace=True)    
-    college_data_clean['2020.student.size'] = student_body_size # this is the last column for my sklearn features, so it also must be last here  
-    print(college_data_clean.drop(columns='STCOUNTYFP').dropna()) # drop rows if there are NaN values in any columns
-    college_data_clean['booster'] = model.predict(college_data_clean.drop(columns='STCOUNTYFP').dropna())
+    # Examples (run them all at once, in parallel, with: python batch.py jobs.json)
+    # my dataset (after basic cleaning applied to my excel file):
+    #   python cleaning.py covid_dates_nice.csv covid_dates_cleaned_script_school.csv
+    # vaccination mandates:
+    #   python cleaning.py vacc_mandates_top.csv vacc_mandates_cleaned_school.csv --date-cols announce_date --last-tracking-date 3/25/2021 --college-name College
+    # boosters -- last tracking date is the earliest booster day I found in my dataset because the other set only tracks vaccine mandates:
+    #   python cleaning.py vacc_mandates_top.csv booster_mandates_cleaned_school.csv --date-cols announce_date --last-tracking-date 12/06/2021 --college-name College
+    # county-level values for all counties (used by the dashboard):
+    #   python cleaning.py all_counties college_data_county.csv --no-date-cols --last-tracking-date 12/06/2021 --ignore-college --county-fips --skip-census
+    parser = argparse.ArgumentParser(description='Add census, COVID, political, region and College Scorecard data to a csv of colleges.')
+    parser.add_argument('input', help=f"csv to clean, or '{ALL_COUNTIES}' for every US county")
+    parser.add_argument('output', help='csv to write')
+    parser.add_argument('--date-cols', nargs='+', default=['Spring2020', 'FirstVaccine', 'Booster', 'Spring2022'],
+                        help='columns with the dates each college acted')
+    parser.add_argument('--no-date-cols', dest='date_cols', action='store_const', const=None, help='the input has no date columns')
+    parser.add_argument('--last-tracking-date', default='4/2/2021', help='date before which to track COVID data')
+    parser.add_argument('--election-year', type=int, default=2016, help='year of the county presidential returns')
+    parser.add_argument('--college-name', default='name', help='column holding the college names')
+    parser.add_argument('--call-scoreboard-api', action='store_true', help='get the College Scorecard data from its API')
+    parser.add_argument('--match-threshold', type=float, default=0.0, help='minimum name similarity for a College Scorecard match')
+    parser.add_argument('--ignore-college', action='store_true', help='skip the College Scorecard stage')
+    parser.add_argument('--county-fips', action='store_true', help="the input has county FIPS codes ('STCOUNTYFP') instead of zip codes")
+    parser.add_argument('--skip-census', action='store_true', help='skip the census stage')
+    parser.add_argument('--no-stage-cache', dest='use_stage_cache', action='store_false', help='recompute every stage')
+    parser.add_argument('--report', dest='report_path', help='json file to write the run report to')
+    parser.add_argument('--log-level', default='INFO')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=args.pop('log_level').upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    input_path, output_path = args.pop('input'), args.pop('output')
+    rows = clean_file(input_path, output_path, **args)
+    logger.info('Wrote %d rows to %s', rows, output_path)
@@ -3,23 +3,114 @@
 # Thanks to the author Pierre-Louis Bescond. Check out the article for more information.
 # Using https://towardsdatascience.com/3-easy-ways-to-make-your-dash-application-look-better-3e4cfefaf772 for styling advice.
 
+import os
+import json
+import logging
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
 from dash_bootstrap_templates import load_figure_template
 import plotly.express as px
+import reference_data
+import booster_inference
+import booster_grid
+import instrumentation
 
-# import fitted model
-import joblib
-model = joblib.load('booster_model.joblib')
+logger = logging.getLogger(__name__)
+
+# use predictions precomputed by booster_grid.py if the 'booster_grid' environment variable is set; otherwise import fitted model
+county_info = booster_inference.county_info
+if os.getenv('booster_grid'):
+    grid, grid_axes = booster_grid.load(os.getenv('booster_grid'), fips=county_info.index)
+else:
+    grid = None
+    booster_inference.load_model(mmap_mode='r')
+
+# county shapes simplified for the whole-country view and for zoomed-in views (tolerances in degrees)
+GEOMETRY_TOLERANCES = {'coarse': 0.02, 'fine': 0.002}
+FINE_GEOMETRY_ZOOM = 6
+
+def load_county_geometry(tolerance):
+    """
+    Returns the geojson of the counties on the map with shared borders simplified to the given tolerance, so the browser gets
+    a fraction of the full file. Simplified files are cached on disk, keyed by the tolerance and the content of the full file
+    (so refreshing it rebuilds them). Needs the optional topojson package; without it the full geometry is used.
+    """
+    source_digest = reference_data.digest('county_geojson')[:16]
+    path = reference_data.cache_dir('geometry', f'counties_{tolerance}_{source_digest}.json')
+    fips = set(county_info['STCOUNTYFP'])
+    if not os.path.exists(path):
+        # geojson file for US counties, from https://plotly.com/python/mapbox-county-choropleth/
+        counties = reference_data.load_json('county_geojson')
+        try:
+            import topojson
+        except ImportError:
+            logger.warning('Install topojson to simplify the county geometry; using the full geometry instead.')
+            return {**counties, 'features': [f for f in counties['features'] if f['id'] in fips]}
+        counties = json.loads(topojson.Topology(counties, toposimplify=tolerance, prevent_oversimplify=True).to_geojson())
+        reference_data.write_atomic(path, json.dumps(counties).encode())
+    with open(path) as f:
+        counties = json.load(f)
+    return {**counties, 'features': [f for f in counties['features'] if f['id'] in fips]}
+
+counties = {detail: load_county_geometry(tolerance) for detail, tolerance in GEOMETRY_TOLERANCES.items()}
+
+def county_probabilities(type, ranking, announce_date, student_body_size):
+    """
+    Returns the booster probability of every county, indexed by FIPS.
+    """
+    if grid is not None:
+        return pd.Series(booster_grid.lookup(grid, grid_axes, type, ranking, announce_date, student_body_size), index=county_info.index)
+    return booster_inference.predict_proba(type, ranking, announce_date, student_body_size)
+
+def percent_boosters(proba):
+    return str(booster_inference.booster_label(proba).sum()/proba.shape[0]*100) + '%'
+
+# Figures are built once with the default inputs; callbacks only send the new probabilities to the browser.
+initial_proba = county_probabilities('Private', 3, 20, 10000)
+
+# create histogram of booster probabilities
+hist_fig = go.Figure(data=[go.Histogram(
+    x=initial_proba.round(4),
+    name='Booster Probability',
+    marker_color='#3D9970'
+)])
+hist_fig.add_vline(x=0.5, line_dash='dash')
+hist_fig.update_layout(xaxis_title_text='Booster Probability', yaxis_title_text='Count')
+hist_fig.update_layout(title_x=0.5, title_y=0.9)
+hist_fig.update_layout(margin=dict(l=50, r=50, t=50, b=50))
+hist_fig.update_layout(xaxis=dict(
+    title='Booster Probability',
+))
+hist_fig.update_layout(yaxis=dict(
+    title='Count',
+))
+hist_fig.update_layout(autosize=False)
+
+# create map of US by county shaded based on output from fitted model
+# All of the map stuff is adapted from https://plotly.com/python/mapbox-county-choropleth/
+map_fig = go.Figure(go.Choroplethmapbox(
+    geojson=counties['coarse'], locations=county_info['STCOUNTYFP'], z=initial_proba.round(4),
+    colorscale=px.colors.sequential.Agsunset,
+    zmid=0.5,
+    marker_opacity=0.5,
+    marker_line_width=0,
+    colorbar={'title': 'Booster Probability'},
+    hovertext=county_info['name'],
+    customdata=county_info[['State', 'STCOUNTYFP']],
+    hovertemplate='<b>%{hovertext}</b><br>State=%{customdata[0]}<br>County=%{customdata[1]}<br>Booster Probability=%{z}<extra></extra>'
+))
+map_fig.update_layout(mapbox_style="carto-positron", mapbox_zoom=3, mapbox_center={"lat": 37.0902, "lon": -95.7129})
+map_fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, legend={'orientation': 'h', 'y': 1, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'})
 
 # Create dash app
 app = dash.Dash(external_stylesheets=[dbc.themes.LUX])
+server = app.server # WSGI entry point for gunicorn (see gunicorn.conf.py)
 load_figure_template('LUX')
 
 # Page structure will be:
@@ -51,7 +142,8 @@ children=[
     ),
     dbc.Row(
         dbc.Col(            
-            dcc.Graph(id='map')       
+            [dcc.Graph(id='map', figure=map_fig),
+             dcc.Store(id='map-detail', data='coarse')]
         )
     ),    
     dbc.Row(
@@ -120,11 +212,11 @@ children=[
         style={'margin-top': '50px'},
     ),
     dbc.Row(
-        [html.H4(id='number-of-boosters'),  
+        [html.H4(percent_boosters(initial_proba), id='number-of-boosters'),  
          html.P('with probability cutoff 0.5')]
     ),
     dbc.Row(
-        dcc.Graph(id='distribution-of-values'),
+        dcc.Graph(id='distribution-of-values', figure=hist_fig),
     ),
     dbc.Row(
         html.A('Jupyter notebook with details of model creation', href='https://github.com/ncrispino/covid_university_dates/blob/master/Covid%20Booster%20Model.ipynb')
@@ -132,72 +224,46 @@ children=[
 ])
 
 # Create callback for histogram using all the values provided and the update_prediction method below
+# The figures are already built with the default values, so only changes to the inputs trigger it.
 @app.callback([Output('number-of-boosters', 'children'), Output('distribution-of-values', 'figure'), Output('map', 'figure')], 
-                [Input('type', 'value'), Input('ranking', 'value'), Input('announce_date', 'value'), Input('student_body_size', 'value')])
-
-# Note that Dash calls this method with default values when it starts.
+                [Input('type', 'value'), Input('ranking', 'value'), Input('announce_date', 'value'), Input('student_body_size', 'value')],
+                prevent_initial_call=True)
+@instrumentation.timed_callback
 def update_prediction(type, ranking, announce_date, student_body_size):    
     """
-    Updates data and figures for all counties based on user-input. Note that in Sci-kit learn, the order of the columns matters, so I have to do some preprocessing.
+    Updates data and figures for all counties based on user-input. The model features are built in booster_inference.py.
+    Only the new probabilities are sent: the figures are patched in the browser instead of being rebuilt with the county geometry.
+    """
+    proba = county_probabilities(type, ranking, announce_date, student_body_size).round(4).tolist()
+    hist_patch = dash.Patch()
+    hist_patch['data'][0]['x'] = proba
+    map_patch = dash.Patch()
+    map_patch['data'][0]['z'] = proba
+    return percent_boosters(pd.Series(proba)), hist_patch, map_patch
+
+# Send the detailed county shapes once the user zooms in far enough to see them.
+@app.callback([Output('map', 'figure', allow_duplicate=True), Output('map-detail', 'data')],
+                [Input('map', 'relayoutData')], [State('map-detail', 'data')],
+                prevent_initial_call=True)
+@instrumentation.timed_callback
+def update_geometry(relayout_data, detail):
+    """
+    Replaces the coarse county geometry with the fine one the first time the map is zoomed in past FINE_GEOMETRY_ZOOM.
+    """
+    zoom = (relayout_data or {}).get('mapbox.zoom')
+    if detail == 'fine' or zoom is None or zoom < FINE_GEOMETRY_ZOOM:
+        return dash.no_update, dash.no_update
+    map_patch = dash.Patch()
+    map_patch['data'][0]['geojson'] = counties['fine']
+    return map_patch, 'fine'
+
+@server.route('/healthz')
+def healthz():
+    """
+    Health check for the load balancer: reports whether predictions come from the model or a precomputed grid.
     """
-    # get data for all counties and merge with user-selected values 
-    college_data = pd.read_csv('college_data_county.csv')
-    column_names = college_data.columns
-    college_data[['ranking', 'announce_date', 'Type']] = [ranking, announce_date, type]
-    college_data = college_data[['ranking', 'announce_date', 'Type', *column_names]]
-    college_data['ranking'] = pd.cut(college_data['ranking'], bins=[0, 20, 100, 200, 298, 400], labels=['a', 'b', 'c', 'd', 'e'], right=False)  # cut the ranking into 5 bins
-    college_data_clean = college_data #.drop(columns=['state', 'state_new', 'STCOUNTYFP', 'state_fips', 'county_fips', 'county_fips_str', 'State', 'State Code', 'Division'])  
-    college_data_clean['STCOUNTYFP_int'] = college_data_clean['STCOUNTYFP']
-    college_data_clean['STCOUNTYFP'] = college_data_clean['STCOUNTYFP'].astype(str).str.zfill(5) # so map can read
-    college_data_clean.drop(columns=['state', 'state_fips', 'county_fips_str', 'State Code', 'Division'], 
-            inplace=True)    
-    college_data_clean['2020.student.size'] = student_body_size # this is the last column for my sklearn features, so it also must be last here          
-    college_data_booster = model.predict(college_data_clean.drop(columns=['STCOUNTYFP', 'State']).dropna())
-    college_data_booster_proba = model.predict_proba(college_data_clean.drop(columns='STCOUNTYFP').dropna())            
-    college_data_clean = college_data_clean.join(pd.Series(college_data_booster, name='booster'), how='right')
-    college_data_clean = college_data_clean.join(pd.DataFrame(college_data_booster_proba, columns=['0', 'Booster Probability']).drop(columns=['0']), how='right')
-    num_boosters = str(college_data_clean['booster'].sum()/college_data_clean.shape[0]*100) + '%'
-    county_names = pd.read_csv('https://github.com/kjhealy/fips-codes/blob/master/state_and_county_fips_master.csv?raw=true').drop(columns=['state'])    
-    college_data_clean = college_data_clean.merge(county_names, left_on='STCOUNTYFP_int', right_on='fips', how='left')
-
-    # create histogram of booster probabilities
-    hist_fig = go.Figure(data=[go.Histogram(
-        x=college_data_clean['Booster Probability'],
-        name='Booster Probability',
-        marker_color='#3D9970'
-    )])
-    hist_fig.add_vline(x=0.5, line_dash='dash')
-    hist_fig.update_layout(xaxis_title_text='Booster Probability', yaxis_title_text='Count')
-    hist_fig.update_layout(title_x=0.5, title_y=0.9)
-    hist_fig.update_layout(margin=dict(l=50, r=50, t=50, b=50))
-    hist_fig.update_layout(xaxis=dict(
-        title='Booster Probability',
-    ))
-    hist_fig.update_layout(yaxis=dict(
-        title='Count',
-    ))
-    hist_fig.update_layout(autosize=False)        
-
-    # create map of US by county shaded based on output from fitted model
-    # first load geojson file for US counties
-    # All of the map stuff is copied from https://plotly.com/python/mapbox-county-choropleth/
-    from urllib.request import urlopen
-    import json
-    with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json') as response:
-        counties = json.load(response) 
-    map_fig = px.choropleth_mapbox(
-        college_data_clean, geojson=counties, locations='STCOUNTYFP', color='Booster Probability',    
-        color_continuous_scale=px.colors.sequential.Agsunset,        
-        color_continuous_midpoint=0.5,              
-        mapbox_style="carto-positron",
-        zoom=3, center={"lat": 37.0902, "lon": -95.7129},
-        opacity=0.5,
-        labels={'STCOUNTYFP': 'County'},
-        hover_name='name',
-        hover_data=['State', 'STCOUNTYFP', 'Booster Probability']
-    )
-    map_fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, legend={'orientation': 'h', 'y': 1, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'})
-    return num_boosters, hist_fig, map_fig
+    return {'status': 'ok', 'mode': 'model' if grid is None else 'grid', 'counties': int(county_info.shape[0])}
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
     app.run_server(debug=True)
\ No newline at end of file
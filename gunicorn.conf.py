@@ -0,0 +1,23 @@
+# Production server for dash_model.py: gunicorn -c gunicorn.conf.py
+# The app (model, county features and geometry) is loaded once in the master process before the workers are forked,
+# so all workers share the same memory instead of loading their own copy.
+import gc
+import logging
+import multiprocessing
+import os
+
+wsgi_app = 'dash_model:server'
+bind = f"0.0.0.0:{os.getenv('PORT', '8050')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+# send the app's logs (including the callback timings from instrumentation.py) to stderr next to gunicorn's own
+logging.basicConfig(level=loglevel.upper(), format='%(asctime)s [%(process)d] %(name)s %(levelname)s %(message)s')
+
+
+def pre_fork(server, worker):
+    # move everything loaded so far out of the garbage collector's reach, so collections in the workers don't touch
+    # (and copy) the shared pages
+    gc.freeze()
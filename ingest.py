@@ -0,0 +1,229 @@
+"""
+Converts the large csv inputs of cleaning.py and dash_model.py to typed, uncompressed Feather (Arrow IPC) files once,
+so later runs memory-map them instead of parsing text. Each converted file is stored with a fingerprint of its source csv;
+if the csv changes, the loaders fall back to reading the csv (with the same types) until it is converted again.
+
+Usage:
+python ingest.py [--force] [name ...] -- convert all (or the given) tables whose source csv exists
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+from functools import lru_cache
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import reference_data
+from instrumentation import count
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_DIR = 'columnar'
+
+# numeric features of the cleaned data, stored as float32 (census vars, community level and vote margin)
+FLOAT32_COLUMNS = ['median_income', 'total_population', 'avg_hhsize', 'avg_community_level', 'county_vote_diff']
+
+# source csv and column types of every table; 'chunksize' tables are converted and read in batches
+TABLES = {
+    'zip_county': {
+        'csv': 'zip-county-fips/ZIP-COUNTY-FIPS_2017-06.csv',
+        'dtypes': {'ZIP': 'int32', 'STCOUNTYFP': 'int32', 'STATE': 'category', 'COUNTYNAME': 'category', 'CLASSFP': 'category'},
+    },
+    'county_pres': {
+        'csv': 'political-data/countypres_2000-2020.csv',
+        'dtypes': {'year': 'int16', 'county_fips': 'Int32', 'state': 'category', 'state_po': 'category', 'county_name': 'category',
+                   'office': 'category', 'candidate': 'category', 'party': 'category', 'mode': 'category'},
+    },
+    'counties_timeseries': {
+        'csv': 'counties.timeseries.csv',
+        'usecols': ['fips', 'date', 'communityLevels.canCommunityLevel'],
+        'dtypes': {'fips': 'int32', 'communityLevels.canCommunityLevel': 'float32'},
+        'dates': ['date'],
+        'chunksize': 500_000,
+    },
+    'scoreboard_size': {
+        'csv': 'scoreboard_size.csv',
+        'dtypes': {'id': 'int32', 'school.zip': 'Int32', '2020.student.size': 'float32'},
+    },
+    'college_data_county': {
+        'csv': 'college_data_county.csv',
+        'dtypes': {'STCOUNTYFP': 'int32', 'state_fips': 'int8', 'county_fips': 'int16', 'state': 'category', 'State': 'category',
+                   'State Code': 'category', 'Region': 'category', 'Division': 'category', 'political_control_state': 'category',
+                   **{col: 'float32' for col in FLOAT32_COLUMNS}},
+    },
+}
+
+
+def columnar_path(name):
+    return os.path.join(COLUMNAR_DIR, f'{name}.feather')
+
+
+def fingerprint(name):
+    """
+    Returns a fingerprint of the source csv of a table (size and modification time) and of how it is typed.
+    """
+    spec = TABLES[name]
+    stat = os.stat(spec['csv'])
+    spec_hash = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+    return {'csv': spec['csv'], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'spec': spec_hash}
+
+
+def is_fresh(name):
+    """
+    Returns true if the columnar file of a table exists and was converted from the current version of its csv.
+    """
+    try:
+        with open(f'{columnar_path(name)}.json') as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        return False
+    if not os.path.exists(TABLES[name]['csv']): # csv wasn't shipped, so use what was converted
+        return os.path.exists(columnar_path(name))
+    return stored == fingerprint(name)
+
+
+def apply_types(df, name):
+    """
+    Casts the columns of a table read from csv to the types given in TABLES.
+    """
+    spec = TABLES[name]
+    dtypes = {col: dtype for col, dtype in spec['dtypes'].items() if col in df.columns}
+    df = df.astype(dtypes)
+    for col in spec.get('dates', []):
+        df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def read_csv_chunks(name, columns=None, chunksize=None):
+    spec = TABLES[name]
+    usecols = columns or spec.get('usecols')
+    chunksize = chunksize or spec.get('chunksize')
+    if chunksize is None:
+        yield apply_types(pd.read_csv(spec['csv'], usecols=usecols), name)
+        return
+    for chunk in pd.read_csv(spec['csv'], usecols=usecols, chunksize=chunksize):
+        yield apply_types(chunk, name)
+
+
+def convert(name):
+    """
+    Converts the csv of a table to an uncompressed Feather file (so it can be memory-mapped) and records the csv's fingerprint.
+    """
+    path = columnar_path(name)
+    os.makedirs(COLUMNAR_DIR, exist_ok=True)
+    source_fingerprint = fingerprint(name)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if TABLES[name].get('chunksize') is None:
+        feather.write_feather(next(read_csv_chunks(name)), tmp_path, compression='uncompressed')
+    else:
+        writer = None
+        for chunk in read_csv_chunks(name):
+            batch = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pa.ipc.new_file(tmp_path, batch.schema)
+            writer.write_table(batch)
+        if writer is None: # empty csv
+            feather.write_feather(apply_types(pd.read_csv(TABLES[name]['csv'], usecols=TABLES[name].get('usecols'), nrows=0), name),
+                                  tmp_path, compression='uncompressed')
+        else:
+            writer.close()
+    os.replace(tmp_path, path)
+    reference_data.write_atomic(f'{path}.json', json.dumps(source_fingerprint).encode())
+    return path
+
+
+def load_table(name, columns=None):
+    """
+    Returns a table as a dataframe, memory-mapping its columnar file if it is up to date and otherwise reading the csv.
+
+    Arguments:
+    name -- key of TABLES.
+    columns -- list of columns to load. Defaults to all of them.
+    """
+    if is_fresh(name):
+        return feather.read_table(columnar_path(name), columns=columns, memory_map=True).to_pandas()
+    count('ingest.csv_reads')
+    logger.warning("Reading %s; run 'python ingest.py %s' to skip csv parsing next time.", TABLES[name]['csv'], name)
+    return pd.concat(read_csv_chunks(name, columns), ignore_index=True)
+
+
+def iter_table(name, columns=None, chunksize=None):
+    """
+    Yields a table as a series of dataframes so it can be processed without holding all of it in memory.
+    Uses the record batches of the memory-mapped columnar file if it is up to date and otherwise reads the csv in chunks.
+
+    Arguments:
+    name -- key of TABLES.
+    columns -- list of columns to load. Defaults to all of them.
+    chunksize -- number of rows per csv chunk. Defaults to the one in TABLES.
+    """
+    if not is_fresh(name):
+        count('ingest.csv_reads')
+        logger.warning("Reading %s; run 'python ingest.py %s' to skip csv parsing next time.", TABLES[name]['csv'], name)
+        yield from read_csv_chunks(name, columns, chunksize)
+        return
+    with pa.memory_map(columnar_path(name)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            yield batch.to_pandas()
+
+
+@lru_cache(maxsize=None)
+def vote_margins():
+    """
+    Returns the Democrat minus Republican share of the total vote in every county (rows, indexed by integer FIPS)
+    for every presidential election year (columns). The table is built from the county presidential returns with a single
+    groupby the first time and saved next to the other columnar files, so later calls (and sweeps over election years)
+    only load a small table. It is rebuilt when the returns csv changes.
+    """
+    path = columnar_path('vote_margins')
+    if os.path.exists(path):
+        with open(f'{path}.json') as f:
+            stored = json.load(f)
+        if not os.path.exists(TABLES['county_pres']['csv']) or stored == fingerprint('county_pres'):
+            margins = feather.read_table(path, memory_map=True).to_pandas().set_index('county_fips')
+            margins.columns = margins.columns.astype(int)
+            return margins
+
+    county_pres = load_table('county_pres', columns=['year', 'county_fips', 'party', 'mode', 'candidatevotes', 'totalvotes'])
+    county_pres = county_pres[county_pres['party'].isin(['DEMOCRAT', 'REPUBLICAN']) & (county_pres['mode'] == 'TOTAL')]
+    county_pres = county_pres.dropna(subset=['county_fips'])
+    percent_vote = county_pres['candidatevotes']/county_pres['totalvotes']
+    vote_shares = (percent_vote.groupby([county_pres['county_fips'].astype('int32'), county_pres['year'], county_pres['party'].astype(str)])
+                   .sum()
+                   .unstack('party'))
+    margins = (vote_shares['DEMOCRAT'] - vote_shares['REPUBLICAN']).unstack('year')
+    margins.columns = margins.columns.astype(int)
+
+    if os.path.exists(TABLES['county_pres']['csv']):
+        os.makedirs(COLUMNAR_DIR, exist_ok=True)
+        saved = margins.copy()
+        saved.columns = saved.columns.astype(str) # feather needs string column names
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        feather.write_feather(saved.reset_index(), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+        reference_data.write_atomic(f'{path}.json', json.dumps(fingerprint('county_pres')).encode())
+    return margins
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    force = '--force' in args
+    names = [arg for arg in args if arg != '--force'] or list(TABLES)
+    for name in names:
+        if not os.path.exists(TABLES[name]['csv']):
+            print(f"{name}: {TABLES[name]['csv']} not found, skipping")
+        elif is_fresh(name) and not force:
+            print(f'{name}: up to date')
+        else:
+            print(f'{name}: wrote {convert(name)}')
+    if 'county_pres' in names and os.path.exists(TABLES['county_pres']['csv']):
+        vote_margins()
+        print(f"vote_margins: wrote {columnar_path('vote_margins')}")
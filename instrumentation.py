@@ -0,0 +1,105 @@
+"""
+Lightweight instrumentation for cleaning.py and dash_model.py, so slow stages and callbacks show up in the logs without a profiler.
+timed() measures a block of code and logs its wall time, rows in and out (and the merge fan-out, rows out per row in),
+the process's peak RSS and the remote calls and cache hits counted with count() while it ran.
+
+Messages go through the 'instrumentation' logger of the logging module, at INFO level for timings; call
+logging.basicConfig(level=logging.INFO) (done by the scripts and gunicorn.conf.py) to see them.
+"""
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+logger = logging.getLogger('instrumentation')
+_counts = Counter()
+_lock = threading.Lock()
+
+
+def count(name, n=1):
+    """
+    Adds n to the counter called name (e.g., 'census.calls' or 'stage_cache.hits'). Safe to call from several threads.
+    """
+    with _lock:
+        _counts[name] += n
+
+
+def counts():
+    """
+    Returns a copy of all counters since the process started.
+    """
+    with _lock:
+        return dict(_counts)
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process in MB, or None if it can't be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak/2**20 if sys.platform == 'darwin' else peak/1024, 1) # bytes on macOS, KB elsewhere
+
+
+def _format(record):
+    parts = [f"{record['name']}: {record['seconds']:.3f}s"]
+    if 'rows_out' in record:
+        parts.append(f"rows {record.get('rows_in')} -> {record['rows_out']}")
+    if record.get('fan_out') is not None:
+        parts.append(f"fan-out {record['fan_out']:.2f}")
+    if record.get('peak_rss_mb') is not None:
+        parts.append(f"peak RSS {record['peak_rss_mb']} MB")
+    parts.extend(f'{name}={value}' for name, value in sorted(record['counts'].items()))
+    if 'error' in record:
+        parts.append(f"failed with {record['error']}")
+    return ', '.join(parts)
+
+
+@contextmanager
+def timed(name, records=None, rows_in=None):
+    """
+    Times the code in the with block and logs it. Yields a dictionary describing the run; set its 'rows_out' inside the block
+    to also log the number of rows produced and the fan-out.
+
+    Arguments:
+    name -- name of the stage or callback.
+    records -- list the finished record is appended to, e.g. to build a run report.
+    rows_in -- number of rows of the input.
+    """
+    record = {'name': name, 'rows_in': rows_in}
+    before = counts()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        rows_out = record.get('rows_out')
+        record['fan_out'] = round(rows_out/rows_in, 4) if rows_in and rows_out is not None else None
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['counts'] = {key: value - before.get(key, 0) for key, value in counts().items() if value != before.get(key, 0)}
+        logger.info(_format(record))
+        if records is not None:
+            records.append(record)
+
+
+def timed_callback(func):
+    """
+    Decorator that times every call of a function (e.g., a Dash callback) with timed().
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
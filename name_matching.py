@@ -0,0 +1,88 @@
+"""
+Vectorized matching of college names, used by cleaning.py to find each college in the College Scorecard.
+Names are cleaned once, turned into sparse token-count vectors over a vocabulary shared by both sides,
+and compared with cosine similarity in one batched sparse operation. Only pairs that share a blocking key
+(e.g., zip code, optionally also state) are compared, so the work grows with the number of candidates rather than
+with the product of the two tables.
+"""
+import re
+import string
+from functools import lru_cache
+
+import nltk
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+@lru_cache(maxsize=None)
+def get_stopwords():
+    """
+    Returns the set of words ignored when comparing names, loaded from the NLTK corpus once per process. Don't modify it.
+    """
+    stopwords = set(nltk.corpus.stopwords.words('english'))
+    stopwords.update(['university', 'college', 'main', 'campus'])
+    return frozenset(stopwords)
+
+
+def clean_name(x, stopwords):
+    """
+    Returns the list of lowercase tokens in a name, without punctuation or stopwords.
+    """
+    text = re.sub('-', ' ', x) # dashes in data -- need to add spaces and remove
+    text = text.lower().translate(PUNCTUATION)
+    # with the punctuation gone, splitting on whitespace gives the same words as a word tokenizer, much faster
+    return [i for i in text.split() if i not in stopwords]
+
+
+def name_vectors(names, stopwords=None):
+    """
+    Returns a row-normalized sparse matrix with one token-count vector per name, so the dot product of two rows is
+    their cosine similarity. Empty names get a row of zeros.
+    """
+    stopwords = get_stopwords() if stopwords is None else stopwords
+    vectorizer = CountVectorizer(analyzer=lambda x: clean_name(x, stopwords))
+    return normalize(vectorizer.fit_transform(names), norm='l2', copy=False)
+
+
+def match_names(left_names, left_keys, right_names, right_keys, top_k=1, threshold=0.0):
+    """
+    For each left name, finds the right names with the same blocking key that are most similar to it.
+    Returns a dataframe with columns 'left', 'right' (positions in the given arrays) and 'name_similarity', holding at most
+    top_k candidates per left name with similarity of at least threshold, sorted by left position and decreasing similarity.
+    Left names without any candidate in their block are not returned.
+
+    Arguments:
+    left_names, right_names -- sequences of names to match.
+    left_keys, right_keys -- blocking keys for each name (e.g., zip codes). Pass a dataframe to block on several columns.
+    top_k -- maximum number of matches to keep for each left name.
+    threshold -- minimum cosine similarity for a match.
+    """
+    # vectorize each distinct name once over a shared vocabulary
+    left_codes, left_uniques = pd.factorize(pd.Series(left_names, dtype=object))
+    right_codes, right_uniques = pd.factorize(pd.Series(right_names, dtype=object))
+    vectors = name_vectors(np.concatenate([np.asarray(left_uniques, dtype=object), np.asarray(right_uniques, dtype=object)]))
+    left_vectors = vectors[:len(left_uniques)]
+    right_vectors = vectors[len(left_uniques):]
+
+    # blocking index: candidate pairs are the left and right positions that share a key
+    left_block = pd.DataFrame(left_keys).reset_index(drop=True)
+    right_block = pd.DataFrame(right_keys).reset_index(drop=True)
+    right_block.columns = left_block.columns
+    left_block['left'] = np.arange(len(left_block))
+    right_block['right'] = np.arange(len(right_block))
+    key_cols = [col for col in left_block.columns if col != 'left']
+    pairs = left_block.dropna(subset=key_cols).merge(right_block.dropna(subset=key_cols), on=key_cols)[['left', 'right']]
+
+    # cosine similarity of every candidate pair at once
+    left_rows = left_vectors[left_codes[pairs['left'].to_numpy()]]
+    right_rows = right_vectors[right_codes[pairs['right'].to_numpy()]]
+    pairs['name_similarity'] = np.asarray(left_rows.multiply(right_rows).sum(axis=1)).ravel()
+
+    pairs = pairs[pairs['name_similarity'] >= threshold]
+    pairs = pairs.sort_values(['left', 'name_similarity'], ascending=[True, False], kind='stable')
+    pairs = pairs[pairs.groupby('left').cumcount() < top_k]
+    return pairs.reset_index(drop=True)
@@ -0,0 +1,148 @@
+"""
+Local on-disk cache for the remote reference tables used by cleaning.py and dash_model.py.
+Each file is downloaded once, stored under the cache directory with a name that includes the hash of its contents,
+and read from disk afterwards, so neither the pipeline nor the dashboard touch the network on the hot path.
+
+The cache directory defaults to '.cache' and can be changed with the 'covid_cache_dir' environment variable.
+Setting 'covid_offline=1' raises an error instead of downloading anything that isn't cached yet.
+
+Usage:
+python reference_data.py list               -- show what is cached
+python reference_data.py refresh [name ...] -- re-download all (or the given) reference files
+"""
+import hashlib
+import json
+import os
+import sys
+from urllib.request import urlopen
+
+import pandas as pd
+
+from instrumentation import count
+
+REFERENCE_URLS = {
+    'county_geojson': 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json',
+    'census_regions': 'https://raw.githubusercontent.com/cphalpert/census-regions/master/us%20census%20bureau%20regions%20and%20divisions.csv',
+    'county_names': 'https://github.com/kjhealy/fips-codes/blob/master/state_and_county_fips_master.csv?raw=true',
+}
+REFERENCE_EXTENSIONS = {'county_geojson': '.json', 'census_regions': '.csv', 'county_names': '.csv'}
+
+
+def cache_dir(*parts):
+    """
+    Returns the path inside the cache directory for the given parts, creating the parent directory if needed.
+    """
+    path = os.path.join(os.getenv('covid_cache_dir', '.cache'), *parts)
+    os.makedirs(os.path.dirname(path) if parts else path, exist_ok=True)
+    return path
+
+
+def is_offline():
+    return os.getenv('covid_offline', '') not in ('', '0', 'false', 'False')
+
+
+def write_atomic(path, data):
+    """
+    Writes bytes to path through a temporary file so readers never see a partially written file.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _manifest_path():
+    return cache_dir('reference', 'manifest.json')
+
+
+def _read_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(manifest):
+    write_atomic(_manifest_path(), json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+
+def fetch(name, refresh=False):
+    """
+    Returns the local path of the reference file called name, downloading it first if it isn't cached (or refresh is true).
+
+    Arguments:
+    name -- key of REFERENCE_URLS.
+    refresh -- true to re-download the file even if it is already cached.
+    """
+    manifest = _read_manifest()
+    entry = manifest.get(name)
+    if entry is not None and not refresh:
+        path = cache_dir('reference', entry['file'])
+        if os.path.exists(path):
+            count('reference.cache_hits')
+            return path
+    if is_offline():
+        raise FileNotFoundError(f"'{name}' is not in the reference cache and offline mode is on. "
+                                "Run 'python reference_data.py refresh' with network access first.")
+    url = REFERENCE_URLS[name]
+    count('reference.downloads')
+    with urlopen(url) as response:
+        data = response.read()
+    digest = hashlib.sha256(data).hexdigest()
+    file_name = f'{name}-{digest[:16]}{REFERENCE_EXTENSIONS[name]}'
+    write_atomic(cache_dir('reference', file_name), data)
+    if entry is not None and entry['file'] != file_name:
+        try:
+            os.remove(cache_dir('reference', entry['file']))
+        except FileNotFoundError:
+            pass
+    manifest = _read_manifest() # re-read in case another process fetched a different file meanwhile
+    manifest[name] = {'url': url, 'file': file_name, 'sha256': digest}
+    _write_manifest(manifest)
+    return cache_dir('reference', file_name)
+
+
+def digest(name):
+    """
+    Returns the sha256 of the content of the reference file called name, downloading it first if it isn't cached, e.g. to key
+    files derived from it so they are rebuilt when it is refreshed.
+    """
+    fetch(name)
+    return _read_manifest()[name]['sha256']
+
+
+def read_csv(name, **kwargs):
+    """
+    Reads a cached reference csv into a dataframe. Keyword arguments are passed to pd.read_csv.
+    """
+    return pd.read_csv(fetch(name), **kwargs)
+
+
+def load_json(name):
+    """
+    Loads a cached reference json file.
+    """
+    with open(fetch(name)) as f:
+        return json.load(f)
+
+
+def refresh(names=None):
+    """
+    Re-downloads the given reference files (all of them by default) into the cache.
+    """
+    for name in names or REFERENCE_URLS:
+        print(f'{name}: {fetch(name, refresh=True)}')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'refresh':
+        refresh(sys.argv[2:])
+    elif command == 'list':
+        manifest = _read_manifest()
+        for name in REFERENCE_URLS:
+            entry = manifest.get(name)
+            print(f"{name}: {entry['file'] if entry else 'not cached'}")
+    else:
+        sys.exit(__doc__)
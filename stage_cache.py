@@ -0,0 +1,168 @@
+"""
+On-disk memoization of the stages of cleaning.cleaning(). Each stage's output is saved under '<cache dir>/stages/<stage>/'
+with a key that hashes the stage's input dataframe, its parameters, its code (bytecode, constants and the values it closes
+over), the code of the helper functions and modules it calls and fingerprints of the data files it reads, so a rerun only
+recomputes the stages whose inputs changed (e.g., changing last_tracking_date reuses the census stage).
+Bump CACHE_VERSION to invalidate every stage after a change the key can't see (e.g., upgrading pandas).
+
+Usage:
+python stage_cache.py list [stage ...]  -- show cached outputs
+python stage_cache.py clear [stage ...] -- delete cached outputs of all (or the given) stages
+"""
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+import types
+
+import pandas as pd
+
+import ingest
+import reference_data
+from instrumentation import count
+
+CACHE_VERSION = 1
+
+
+def frame_hash(df):
+    """
+    Returns a hash of a dataframe's values, index, column names and dtypes.
+    """
+    h = hashlib.sha256()
+    h.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except TypeError: # unhashable cells, e.g. lists
+        h.update(pickle.dumps(df))
+    return h.hexdigest()
+
+
+def source_fingerprint(source):
+    """
+    Returns a fingerprint of a data source read by a stage: an ingest table or a reference_data file.
+    """
+    if source in ingest.TABLES:
+        if os.path.exists(ingest.TABLES[source]['csv']):
+            return ingest.fingerprint(source)
+        return os.path.exists(ingest.columnar_path(source)) and os.stat(ingest.columnar_path(source)).st_mtime_ns
+    if source in reference_data.REFERENCE_URLS:
+        return reference_data.fetch(source) # file names include the hash of the contents
+    raise KeyError(f'Unknown data source {source!r}.')
+
+
+def _stable_repr(value):
+    if isinstance(value, (set, frozenset)): # iteration order of sets of strings changes between processes
+        return repr(sorted(value, key=repr))
+    return repr(value)
+
+
+def code_hash(obj, _seen=None):
+    """
+    Returns a hash of the code of a function (its bytecode, names and constants, including nested functions, and the values
+    it closes over) or of the source file of a module, given as the module or its name (so it doesn't have to be imported).
+    """
+    h = hashlib.sha256()
+    if isinstance(obj, str) or inspect.ismodule(obj):
+        path = importlib.util.find_spec(obj).origin if isinstance(obj, str) else obj.__file__
+        with open(path, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+    _seen = set() if _seen is None else _seen
+    _seen.add(id(obj))
+
+    def update(code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                update(const)
+            else:
+                h.update(_stable_repr(const).encode())
+    update(obj.__code__)
+    for cell in obj.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError: # not assigned yet
+            continue
+        if inspect.isfunction(value):
+            h.update(b'' if id(value) in _seen else code_hash(value, _seen).encode())
+        else:
+            h.update(_stable_repr(value).encode())
+    return h.hexdigest()
+
+
+def stage_key(func, frame, params, sources, helpers=()):
+    h = hashlib.sha256()
+    h.update(str(CACHE_VERSION).encode())
+    h.update(frame_hash(frame).encode())
+    h.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    for code in [func, *helpers]:
+        h.update(code_hash(code).encode())
+    h.update(json.dumps([source_fingerprint(source) for source in sources], default=repr).encode())
+    return h.hexdigest()[:24]
+
+
+def run_stage(stage, func, frame, params, sources=(), helpers=()):
+    """
+    Returns func(frame, **params), loading it from the stage cache if it was computed before with the same inputs.
+
+    Arguments:
+    stage -- name of the stage, used as the cache subdirectory.
+    func -- function computing the stage.
+    frame -- input dataframe of the stage.
+    params -- dictionary of the other arguments of func. Must be json serializable (or have a stable repr).
+    sources -- names of the ingest tables and reference_data files the stage reads.
+    helpers -- functions and modules func calls whose code changes its output (hashed whole for modules).
+    """
+    path = reference_data.cache_dir('stages', stage, f'{stage_key(func, frame, params, sources, helpers)}.pkl')
+    if os.path.exists(path):
+        count('stage_cache.hits')
+        return pd.read_pickle(path)
+    count('stage_cache.misses')
+    result = func(frame, **params)
+    reference_data.write_atomic(path, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    return result
+
+
+def list_stages(stages=None):
+    """
+    Returns a dataframe with the stage, key, size in bytes and modification time of every cached stage output.
+    """
+    stage_dir = reference_data.cache_dir('stages')
+    rows = []
+    if not os.path.isdir(stage_dir): # nothing has been cached yet
+        return pd.DataFrame(rows, columns=['stage', 'key', 'bytes', 'modified'])
+    for stage in sorted(stages or os.listdir(stage_dir)):
+        if not os.path.isdir(os.path.join(stage_dir, stage)):
+            continue
+        for file_name in sorted(os.listdir(os.path.join(stage_dir, stage))):
+            stat = os.stat(os.path.join(stage_dir, stage, file_name))
+            rows.append({'stage': stage, 'key': file_name.removesuffix('.pkl'), 'bytes': stat.st_size,
+                         'modified': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))})
+    return pd.DataFrame(rows, columns=['stage', 'key', 'bytes', 'modified'])
+
+
+def clear(stages=None):
+    """
+    Deletes the cached outputs of the given stages (all of them by default).
+    """
+    stage_dir = reference_data.cache_dir('stages')
+    if not os.path.isdir(stage_dir):
+        return
+    for stage in stages or os.listdir(stage_dir):
+        shutil.rmtree(os.path.join(stage_dir, stage), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'list':
+        print(list_stages(sys.argv[2:]).to_string(index=False))
+    elif command == 'clear':
+        clear(sys.argv[2:])
+    else:
+        sys.exit(__doc__)